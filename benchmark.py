@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+#Measures the hot loop of the real game classes and compares the results against a stored baseline.
+#Run "python benchmark.py --dummy --save baseline.json" once and "python benchmark.py --dummy --baseline baseline.json" later
+class Benchmark(object):
+    #Physics steps per second, the game's rate unless --physics-rate sets another
+    physics_rate = None
+
+    def __init__(self, quick=False) -> None:
+        self.quick = quick
+        self.results = {}
+
+    def scale(self, count):
+        return max(1, count // 10) if self.quick else count
+
+    @staticmethod
+    def percentiles(samples):
+        samples = sorted(samples)
+        def at(fraction):
+            return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+        return {'p50': at(0.50), 'p95': at(0.95), 'p99': at(0.99), 'max': samples[-1]}
+
+    #Times every call of function in microseconds and stores throughput and latency percentiles
+    def measure(self, name, function, count, before=None):
+        samples = []
+        clock = time.perf_counter_ns
+        for index in range(count):
+            if before:
+                before(index)
+            start = clock()
+            function()
+            samples.append((clock() - start) / 1000)
+        total = sum(samples)
+        result = {'per_second': count / (total / 1e6) if total else float('inf'), 'mean_us': total / count}
+        result.update({key + '_us': value for key, value in Benchmark.percentiles(samples).items()})
+        self.results[name] = result
+        return result
+
+    @staticmethod
+    def configure(**settings) -> None:
+        from pinball_45 import Settings
+        defaults = {'headless': True, 'collision': "mask", 'substeps': 1, 'dirty_rendering': False, 'gameover': False, 'balls': 1,
+                    'timestep': 1.0 / Benchmark.physics_rate if Benchmark.physics_rate else Settings.timestep, 'deltatime': 1.0 / Settings.fps}
+        defaults.update(settings)
+        for key, value in defaults.items():
+            setattr(Settings, key, value)
+
+    #Ball lying against the lower left diagonal wall
+    @staticmethod
+    def place_on_wall(table) -> None:
+        ball = table.ball.sprite
+        ball.rect.center = (198, 647)
+        ball.direction.update(0, 0)
+
+    #Ball sitting on the left rail
+    @staticmethod
+    def place_on_rail(table) -> None:
+        ball = table.ball.sprite
+        ball.rect.center = (272, 716)
+        ball.direction.update(0, 0)
+
+    #Ball launched from the ChargedLauncher at full charge
+    @staticmethod
+    def launch(table) -> None:
+        launcher = table.chargedlauncher.sprite
+        launcher.ball_number = 0
+        launcher.place_ball()
+        launcher.control_ball()
+        launcher.controlling = True
+        launcher.force = 3000
+        launcher.launch_ball()
+
+    def physics(self) -> None:
+        from pinball_45 import Settings, Simulation
+        scenarios = [("wall", Benchmark.place_on_wall, 0.5), ("rail", Benchmark.place_on_rail, 0.5), ("launch", Benchmark.launch, 3.3)]
+        for collision in ("mask", "analytic"):
+            for name, place, seconds in scenarios:
+                Benchmark.configure(collision=collision)
+                simulation = Simulation(Settings.timestep)
+                table = simulation.table
+                period = max(1, round(seconds / Settings.timestep))
+                def before(index):
+                    if index % period == 0:
+                        place(table)
+                simulation.enter()
+                self.measure("physics.{}.{}".format(collision, name), simulation.advance, self.scale(6000), before)
+                simulation.leave()
+
+    #Extra balls dropped from the top of the playfield, again every two seconds. Thousands of balls need a smaller radius to fit
+    def multiball(self) -> None:
+        from pinball_45 import Settings, Simulation, MultiBall, numpy
+        if numpy is None:
+            print("multiball needs numpy, skipped")
+            return
+        for count, radius in ((10, None), (100, None), (1000, 6), (3000, 3)):
+            Benchmark.configure()
+            simulation = Simulation(Settings.timestep)
+            table = simulation.table
+            period = round(2.0 / Settings.timestep)
+            def before(index):
+                if index % period == 0:
+                    table.multiball = MultiBall(table, count, radius)
+            simulation.enter()
+            self.measure("multiball.{}".format(count), simulation.advance, self.scale(1200), before)
+            simulation.leave()
+
+    #Table layout with extra wall pieces spread over the playfield
+    @staticmethod
+    def crowded_layout(directory, pieces):
+        from pinball_45 import Settings
+        with open(Settings.tablepath(Settings.layout)) as file:
+            data = json.load(file)
+        columns = 20
+        for index in range(pieces):
+            data['walls'].append({'type': "WallH", 'x': 170 + (index % columns) * 22, 'y': 130 + (index // columns * 17) % 420,
+                                  'width': 5, 'height': 12})
+        path = os.path.join(directory, "crowded_{}.json".format(pieces))
+        with open(path, 'w') as file:
+            json.dump(data, file)
+        return path
+
+    def collision(self) -> None:
+        from pinball_45 import Table
+        with tempfile.TemporaryDirectory() as directory:
+            for pieces in (0, 100, 1000):
+                path = Benchmark.crowded_layout(directory, pieces)
+                for collision in ("mask", "analytic"):
+                    Benchmark.configure(collision=collision)
+                    table = Table(path)
+                    ball = table.ball.sprite
+                    def before(index):
+                        ball.rect.center = (300 + index % 200, 300 + index % 150)
+                        ball.direction.update(0, 0)
+                    self.measure("collision.{}.{}".format(collision, len(table.layout.images)), table.assign_collision, self.scale(3000), before)
+
+    def rendering(self) -> None:
+        import pygame
+        from pinball_45 import Game, Settings
+        for mode in ("full", "no_background", "dirty"):
+            Benchmark.configure(headless=False, dirty_rendering=mode == "dirty")
+            game = Game()
+            table = game.table
+            def before(index):
+                if index % 200 == 0:
+                    Benchmark.launch(table)
+                game.update()
+            if mode == "no_background":
+                def draw():
+                    table.draw(game.screen)
+                    pygame.display.flip()
+            else:
+                draw = game.draw
+            self.measure("draw.{}".format(mode), draw, self.scale(1000), before)
+            game.quit()
+        Settings.headless = True
+
+    def text(self) -> None:
+        from pinball_45 import Display, Settings
+        Benchmark.configure(headless=False)
+        import pygame
+        pygame.font.init()
+        display = Display(400, 200, 0)
+        points = [0]
+        def update():
+            points[0] += 1000
+            display.update(points[0])
+            display.rendered_text
+        self.measure("text.display_update", update, self.scale(3000))
+        Settings.headless = True
+
+    #Import to first frame in a fresh interpreter
+    def startup(self) -> None:
+        script = ("import time; start = time.perf_counter(); import pinball_45; game = pinball_45.Game(); game.draw(); "
+                  "print(time.perf_counter() - start)")
+        directory = os.path.dirname(os.path.abspath(__file__))
+        samples = []
+        for _ in range(3 if self.quick else 7):
+            output = subprocess.run([sys.executable, "-c", script], cwd=directory, capture_output=True, text=True, check=True)
+            samples.append(float(output.stdout.split()[-1]) * 1e6)
+        result = {'mean_us': sum(samples) / len(samples)}
+        result.update({key + '_us': value for key, value in Benchmark.percentiles(samples).items()})
+        self.results["startup.first_frame"] = result
+
+    def run(self, groups) -> dict:
+        for group in groups:
+            getattr(self, group)()
+        return self.results
+
+    #Returns the metrics that got worse by more than tolerance. Throughput should not fall, times should not rise
+    @staticmethod
+    def compare(results, baseline, tolerance):
+        regressions = []
+        for name, metrics in results.items():
+            for metric, value in metrics.items():
+                previous = baseline.get(name, {}).get(metric)
+                if not previous:
+                    continue
+                change = value / previous - 1
+                if metric == 'per_second':
+                    change = -change
+                if metric in ('per_second', 'mean_us', 'p50_us', 'p95_us') and change > tolerance:
+                    regressions.append((name, metric, previous, value, change))
+        return regressions
+
+
+def main() -> int:
+    groups = ["physics", "multiball", "collision", "rendering", "text", "startup"]
+    parser = argparse.ArgumentParser(description="Benchmarks for Pinball 45")
+    parser.add_argument("groups", nargs="*", help="any of " + ", ".join(groups))
+    parser.add_argument("--save", help="write the results as json to this file")
+    parser.add_argument("--baseline", help="compare against results saved earlier with --save")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown before a metric counts as regression")
+    parser.add_argument("--quick", action="store_true", help="run a tenth of the iterations")
+    parser.add_argument("--dummy", action="store_true", help="use SDL's dummy video and audio drivers")
+    parser.add_argument("--physics-rate", type=float, help="physics steps per second, the game's rate by default")
+    arguments = parser.parse_args()
+    for group in arguments.groups:
+        if group not in groups:
+            parser.error("unknown benchmark group " + group)
+    if arguments.dummy:
+        os.environ['SDL_VIDEODRIVER'] = "dummy"
+        os.environ['SDL_AUDIODRIVER'] = "dummy"
+
+    from pinball_45 import Settings
+    Benchmark.physics_rate = arguments.physics_rate or 1.0 / Settings.timestep
+    results = Benchmark(arguments.quick).run(arguments.groups or groups)
+    for name, metrics in results.items():
+        print("{:32} {}".format(name, "  ".join("{} {:.1f}".format(key, value) for key, value in metrics.items())))
+    if arguments.save:
+        with open(arguments.save, 'w') as file:
+            json.dump(results, file, indent=4, sort_keys=True)
+    if arguments.baseline:
+        with open(arguments.baseline) as file:
+            regressions = Benchmark.compare(results, json.load(file), arguments.tolerance)
+        for name, metric, previous, value, change in regressions:
+            print("REGRESSION {} {}: {:.1f} -> {:.1f} ({:+.0%})".format(name, metric, previous, value, change))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
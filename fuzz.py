@@ -0,0 +1,423 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+#Follows one ball through a case and checks the physics invariants after every step: the ball stays inside the table,
+#it is not left inside a wall, it does not gain energy unless a flipper or the launcher gives it some, and it does not
+#get trapped bouncing in a small area. check() returns the first broken invariant as (kind, detail) or None
+class Watch(object):
+    #Tolerances in pixels, the mask engine places the ball on whole pixels
+    tolerance = {'mask': 1.5, 'analytic': 0.1}
+    #Overlap with a wall is allowed for a moment while a collision is resolved, not for longer than this
+    in_wall_seconds = 0.05
+    energy_margin = 0.02
+    trap_seconds = 3.0
+
+    def __init__(self, table, walls, collision, timestep) -> None:
+        self.table = table
+        self.ball = table.ball.sprite
+        self.flippers = [table.leftflipper.sprite, table.rightflipper.sprite]
+        self.launcher = table.chargedlauncher.sprite
+        self.walls = walls
+        self.timestep = timestep
+        self.tolerance = Watch.tolerance[collision]
+        self.in_wall_steps = max(1, int(round(Watch.in_wall_seconds / timestep)))
+        self.trap_steps = int(round(Watch.trap_seconds / timestep))
+        self.in_wall = 0
+        self.energy = self.current_energy()
+        self.trap_box = None
+        self.trap_start = 0
+
+    def current_energy(self):
+        ball = self.ball
+        return 0.5 * ball.direction.length_squared() + ball.gravity * (self.table.b_guide - ball.pos[1])
+
+    #Deepest overlap of the ball with a wall segment
+    def wall_depth(self):
+        ball = self.ball
+        x, y = ball.pos
+        radius = ball.radius
+        depth = 0.0
+        for wall in self.walls.query(x - radius, y - radius, x + radius, y + radius):
+            contact = wall.contact(ball.pos, radius, ball.direction)
+            if contact and contact[1] > depth:
+                depth = contact[1]
+        return depth
+
+    #A ball the flipper hit may already be a step away from it
+    def near_flipper(self):
+        ball = self.ball
+        reach = ball.radius + 2 + ball.direction.length() * self.timestep * 2
+        for flipper in self.flippers:
+            if flipper.segment.contact(ball.pos, reach, ball.direction):
+                return True
+        return False
+
+    def check(self, step):
+        table = self.table
+        ball = self.ball
+        ball.sync_position()
+        x, y = ball.pos
+        radius = ball.radius
+        tolerance = self.tolerance
+        #Below the bottom guide the ball is draining and past the ends of the walls
+        if y <= table.b_guide and (x - radius < table.l_guide - tolerance or x + radius > table.r_guide + tolerance
+                                   or y - radius < table.t_guide - tolerance):
+            return "outside", "ball at ({:.2f}, {:.2f})".format(x, y)
+
+        depth = self.wall_depth()
+        if depth > tolerance:
+            self.in_wall += 1
+            if self.in_wall >= self.in_wall_steps:
+                return "in_wall", "ball at ({:.2f}, {:.2f}) {:.2f} px inside a wall for {} steps".format(x, y, depth, self.in_wall)
+        else:
+            self.in_wall = 0
+
+        #Flippers and the launcher add energy, the reference starts again from what the ball has after them
+        energy = self.current_energy()
+        if self.launcher.controlling or self.near_flipper():
+            self.energy = energy
+        elif energy > self.energy + abs(self.energy) * Watch.energy_margin + ball.gravity * tolerance * 2:
+            return "energy", "energy grew from {:.0f} to {:.0f} with the ball at ({:.2f}, {:.2f})".format(self.energy, energy, x, y)
+        else:
+            self.energy = min(self.energy, energy)
+
+        if self.launcher.controlling or any(flipper.target == flipper.active_angle for flipper in self.flippers):
+            self.trap_box = None
+        elif self.trap_box is None:
+            self.trap_box = [x, y, x, y]
+            self.trap_start = step
+        else:
+            box = self.trap_box
+            box[0], box[1], box[2], box[3] = min(box[0], x), min(box[1], y), max(box[2], x), max(box[3], y)
+            if box[2] - box[0] > radius * 4 or box[3] - box[1] > radius * 4:
+                self.trap_box = [x, y, x, y]
+                self.trap_start = step
+            elif step - self.trap_start >= self.trap_steps:
+                return "trapped", "ball kept within ({:.0f}, {:.0f}, {:.0f}, {:.0f}) for {:g} s".format(
+                    box[0], box[1], box[2], box[3], (step - self.trap_start) * self.timestep)
+        return None
+
+
+#Throws randomised balls at the table headless, in parallel, and reports the cases that break an invariant.
+#A case is a start position and velocity, flipper presses as [step, side, held] and a number of steps, all from one
+#seed. Failing cases are reduced to the fewest steps and presses and the roundest numbers that still fail the same
+#way, and written as JSON files "python fuzz.py --replay" runs again. The golden trajectories of a fixed seed set are
+#hashed into golden.json, so a change to the physics or the collision code shows which cases move and from when
+class Fuzz(object):
+    kinds = ["outside", "in_wall", "energy", "trapped"]
+    sides = ["left", "right"]
+    golden_chunks = 16
+
+    #Builds the table once per worker process, every case then starts from a restore of its first state
+    @staticmethod
+    def setup(collision, timestep, layout) -> None:
+        from pinball_45 import pygame, Settings, Simulation, SpatialGrid, WallSegment, KEYDOWN, KEYUP, K_a, K_d
+        Settings.collision = collision
+        Settings.layout = layout
+        Settings.substeps = 1
+        Fuzz.settings = Settings
+        Fuzz.collision = collision
+        Fuzz.timestep = timestep
+        Fuzz.layout = layout
+        Fuzz.simulation = Simulation(timestep)
+        #The cases step the table directly, so the settings of the simulation stay in place
+        Fuzz.simulation.enter()
+        Fuzz.table = Fuzz.simulation.table
+        Fuzz.table.hits = None
+        Fuzz.start = Fuzz.table.snapshot()
+        Fuzz.walls = SpatialGrid(Settings.grid_cell)
+        for segment in Fuzz.table.layout.segments():
+            if isinstance(segment, WallSegment):
+                Fuzz.walls.insert(segment, segment.left, segment.top, segment.right, segment.bottom)
+        Fuzz.vector = pygame.Vector2
+        Fuzz.event = pygame.event.Event
+        Fuzz.keys = {'left': K_a, 'right': K_d}
+        Fuzz.event_kinds = {1: KEYDOWN, 0: KEYUP}
+
+    #Case of a seed: a free spot on the table, any direction up to max_speed and a few flipper presses
+    @staticmethod
+    def generate(seed, seconds, max_speed=2000.0):
+        rng = random.Random(seed)
+        table = Fuzz.table
+        ball = table.ball.sprite
+        flippers = [table.leftflipper.sprite, table.rightflipper.sprite]
+        radius = ball.radius
+        while True:
+            x = rng.uniform(table.l_guide + radius, table.r_guide - radius)
+            y = rng.uniform(table.t_guide + radius, table.b_guide - radius)
+            center = Fuzz.vector(x, y)
+            if any(wall.contact(center, radius + 1, ball.direction)
+                   for wall in Fuzz.walls.query(x - radius - 1, y - radius - 1, x + radius + 1, y + radius + 1)):
+                continue
+            if any(flipper.segment.contact(center, radius + 1, ball.direction) for flipper in flippers):
+                continue
+            break
+        angle = rng.uniform(0, 2 * math.pi)
+        speed = rng.uniform(0, max_speed)
+        steps = int(round(seconds / Fuzz.timestep))
+        flips = []
+        for side in Fuzz.sides:
+            step = 0
+            for _ in range(rng.randint(0, 4)):
+                step += rng.randint(1, steps // 4)
+                held = rng.randint(10, 200)
+                if step + held >= steps:
+                    break
+                flips.append([step, side, 1])
+                flips.append([step + held, side, 0])
+                step += held
+        flips.sort(key=lambda flip: (flip[0], flip[1]))
+        return {'seed': seed, 'collision': Fuzz.collision, 'timestep': Fuzz.timestep, 'layout': Fuzz.layout, 'x': x, 'y': y,
+                'vx': speed * math.cos(angle), 'vy': speed * math.sin(angle), 'flips': flips, 'steps': steps}
+
+    #Runs a case until it breaks an invariant, drains, rolls back into the launcher or runs out of steps.
+    #With trace the ball positions are hashed in golden_chunks pieces
+    @staticmethod
+    def play(case, trace=False):
+        table = Fuzz.table
+        ball = table.ball.sprite
+        launcher = table.chargedlauncher.sprite
+        table.restore(Fuzz.start)
+        Fuzz.settings.gameover = False
+        launcher.controlling = False
+        launcher.charging = False
+        ball.move_to((case['x'], case['y']))
+        ball.previous.update(ball.pos)
+        ball.direction.update(case['vx'], case['vy'])
+        watch = Watch(table, Fuzz.walls, Fuzz.collision, Fuzz.timestep)
+        flips = case['flips']
+        next_flip = 0
+        chunk = max(1, case['steps'] // Fuzz.golden_chunks)
+        hashes = []
+        digest = hashlib.sha256()
+        outcome = "timeout"
+        violation = None
+        step = 0
+        for step in range(1, case['steps'] + 1):
+            while next_flip < len(flips) and flips[next_flip][0] < step:
+                flip_step, side, held = flips[next_flip]
+                table.watch_for_events(Fuzz.event(Fuzz.event_kinds[held], key=Fuzz.keys[side]))
+                next_flip += 1
+            table.step(Fuzz.timestep)
+            if launcher.ball_number != 1:
+                outcome = "drained"
+                break
+            if trace:
+                digest.update(struct.pack('<dd', ball.pos[0], ball.pos[1]))
+                if step % chunk == 0:
+                    hashes.append(digest.hexdigest()[:16])
+            broken = watch.check(step)
+            if broken:
+                violation = {'kind': broken[0], 'step': step, 'detail': broken[1]}
+                outcome = "violation"
+                break
+            if launcher.controlling:
+                outcome = "launcher"
+                break
+        if trace and (not hashes or step % chunk):
+            hashes.append(digest.hexdigest()[:16])
+        return {'seed': case.get('seed'), 'outcome': outcome, 'steps': step, 'points': table.score.points,
+                'violation': violation, 'hashes': hashes}
+
+    @staticmethod
+    def fails(case, kind):
+        violation = Fuzz.play(case)['violation']
+        return violation is not None and violation['kind'] == kind
+
+    #Shortens a failing case while it still breaks the same invariant: it stops at the failing step, drops the
+    #flipper presses one at a time with their releases and rounds the start numbers
+    @staticmethod
+    def reduce(case):
+        violation = Fuzz.play(case)['violation']
+        kind = violation['kind']
+        case = dict(case, flips=[list(flip) for flip in case['flips']], steps=violation['step'])
+        case['flips'] = [flip for flip in case['flips'] if flip[0] < case['steps']]
+        changed = True
+        while changed:
+            changed = False
+            for index, (step, side, held) in enumerate(case['flips']):
+                if not held:
+                    continue
+                release = next((other for other in case['flips'][index + 1:] if other[1] == side), None)
+                flips = [flip for flip in case['flips'] if flip is not case['flips'][index] and flip is not release]
+                if Fuzz.fails(dict(case, flips=flips), kind):
+                    case['flips'] = flips
+                    changed = True
+                    break
+        for key in ('x', 'y', 'vx', 'vy'):
+            for digits in (0, 1, 3):
+                rounded = dict(case, **{key: round(case[key], digits)})
+                if Fuzz.fails(rounded, kind):
+                    case = rounded
+                    break
+        result = Fuzz.play(case)
+        case['steps'] = result['violation']['step']
+        case['violation'] = result['violation']
+        return case
+
+    #Plays the case of a seed, a failing one comes back reduced
+    @staticmethod
+    def fuzz(job):
+        seed, seconds = job
+        case = Fuzz.generate(seed, seconds)
+        result = Fuzz.play(case)
+        if result['violation']:
+            result['case'] = Fuzz.reduce(case)
+        return result
+
+    @staticmethod
+    def trace(job):
+        seed, seconds = job
+        return Fuzz.play(Fuzz.generate(seed, seconds), trace=True)
+
+    @staticmethod
+    def run(function, jobs, processes, collision, timestep, layout):
+        chunksize = max(1, len(jobs) // (processes * 8))
+        with ProcessPoolExecutor(processes, initializer=Fuzz.setup, initargs=(collision, timestep, layout)) as pool:
+            return list(pool.map(function, jobs, chunksize=chunksize))
+
+    @staticmethod
+    def report(results):
+        total = len(results)
+        outcomes = {}
+        for result in results:
+            outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+        lines = ["  ".join("{} {:.1%}".format(outcome, count / total) for outcome, count in sorted(outcomes.items()))]
+        failing = [result for result in results if result['violation']]
+        for kind in Fuzz.kinds:
+            cases = [result for result in failing if result['violation']['kind'] == kind]
+            if cases:
+                lines.append("{:8} {:>6} cases, seeds {}".format(kind, len(cases), " ".join(str(result['seed']) for result in cases[:10])
+                                                                  + (" ..." if len(cases) > 10 else "")))
+        if not failing:
+            lines.append("no invariant broken")
+        return "\n".join(lines)
+
+    @staticmethod
+    def save_cases(results, directory):
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for result in results:
+            if result['violation']:
+                case = result['case']
+                path = os.path.join(directory, "{}-{}-{}.json".format(case['collision'], case['violation']['kind'], case['seed']))
+                with open(path, 'w') as file:
+                    json.dump(case, file, indent=1)
+                paths.append(path)
+        return paths
+
+    @staticmethod
+    def golden(results):
+        return {str(result['seed']): {'outcome': result['outcome'], 'steps': result['steps'], 'points': result['points'],
+                                      'hashes': result['hashes']} for result in results}
+
+    #Cases whose trajectory is not the golden one, with the time from which it differs
+    @staticmethod
+    def golden_diff(golden, results, timestep, seconds):
+        lines = []
+        chunk_seconds = max(1, int(round(seconds / timestep)) // Fuzz.golden_chunks) * timestep
+        for seed, now in sorted(Fuzz.golden(results).items(), key=lambda item: int(item[0])):
+            before = golden.get(seed)
+            if before == now:
+                continue
+            if before is None:
+                lines.append("seed {:>4}  not in the golden file".format(seed))
+                continue
+            first = next((index for index, (old, new) in enumerate(zip(before['hashes'], now['hashes'])) if old != new),
+                         min(len(before['hashes']), len(now['hashes'])))
+            lines.append("seed {:>4}  differs from {:.2f}-{:.2f} s  {} after {} steps, {} points -> {} after {} steps, {} points".format(
+                seed, first * chunk_seconds, (first + 1) * chunk_seconds, before['outcome'], before['steps'], before['points'],
+                now['outcome'], now['steps'], now['points']))
+        return lines
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Physics invariant fuzzer and golden trajectories for Pinball 45")
+    parser.add_argument("--cases", type=int, default=10000, help="random cases to run")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first case, the others follow it")
+    parser.add_argument("--seconds", type=float, default=10.0, help="simulated time of a case")
+    parser.add_argument("--collision", choices=["mask", "analytic", "both"], default="both")
+    parser.add_argument("--layout", help="table layout in tables/, classic.json or the one of the case or golden file")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes, all cores by default")
+    parser.add_argument("--out", default="fuzz-cases", help="directory for the reduced failing cases")
+    parser.add_argument("--replay", metavar="CASE", help="run one case file again and show what it breaks")
+    parser.add_argument("--golden", choices=["check", "save"], help="compare the golden trajectories with golden.json or save them")
+    parser.add_argument("--golden-file", default="golden.json")
+    parser.add_argument("--golden-cases", type=int, default=64, help="seeds 0 and up that make the golden set when saving it")
+    arguments = parser.parse_args()
+
+    from pinball_45 import Settings
+    timestep = Settings.timestep
+    collisions = ["mask", "analytic"] if arguments.collision == "both" else [arguments.collision]
+
+    #Case and golden files keep the layout and timestep they ran with, older files the defaults of the time
+    if arguments.replay:
+        with open(arguments.replay) as file:
+            case = json.load(file)
+        layout = case.get('layout', arguments.layout or "classic.json")
+        if arguments.layout and arguments.layout != layout:
+            print("{} ran on {}, not {}".format(arguments.replay, layout, arguments.layout))
+            return 2
+        Fuzz.setup(case['collision'], case['timestep'], layout)
+        result = Fuzz.play(case)
+        violation = result['violation']
+        print("{} after {} steps, {} points".format(result['outcome'], result['steps'], result['points']))
+        if violation:
+            print("{} at step {}: {}".format(violation['kind'], violation['step'], violation['detail']))
+        return 1 if violation else 0
+
+    #The golden file keeps the case length, seed count, timestep and layout it was saved with, so a check replays the
+    #same cases
+    if arguments.golden:
+        golden = {'seconds': arguments.seconds, 'cases': arguments.golden_cases, 'timestep': timestep,
+                  'layout': arguments.layout or "classic.json"}
+        if arguments.golden == "check":
+            with open(arguments.golden_file) as file:
+                golden = dict({'timestep': timestep, 'layout': "classic.json"}, **json.load(file))
+            if arguments.layout and arguments.layout != golden['layout']:
+                print("{} was saved on {}, not {}".format(arguments.golden_file, golden['layout'], arguments.layout))
+                return 2
+        jobs = [(seed, golden['seconds']) for seed in range(golden['cases'])]
+        differing = 0
+        for collision in collisions:
+            results = Fuzz.run(Fuzz.trace, jobs, arguments.processes, collision, golden['timestep'], golden['layout'])
+            if arguments.golden == "save":
+                golden[collision] = Fuzz.golden(results)
+                continue
+            lines = Fuzz.golden_diff(golden.get(collision, {}), results, golden['timestep'], golden['seconds'])
+            differing += len(lines)
+            print("{} collision: {} of {} golden trajectories differ".format(collision, len(lines), len(results)))
+            for line in lines:
+                print("  " + line)
+        if arguments.golden == "save":
+            with open(arguments.golden_file, 'w') as file:
+                json.dump(golden, file, indent=1, sort_keys=True)
+            print("saved {} golden trajectories per collision to {}".format(len(jobs), arguments.golden_file))
+        return 1 if differing else 0
+
+    jobs = [(seed, arguments.seconds) for seed in range(arguments.seed, arguments.seed + arguments.cases)]
+    failed = 0
+    for collision in collisions:
+        start = time.perf_counter()
+        results = Fuzz.run(Fuzz.fuzz, jobs, arguments.processes, collision, timestep, arguments.layout or "classic.json")
+        print("{} collision: {} cases in {:.1f} s on {} processes ({:g} s each)".format(
+            collision, len(results), time.perf_counter() - start, arguments.processes, arguments.seconds))
+        print(Fuzz.report(results))
+        paths = Fuzz.save_cases(results, arguments.out)
+        failed += len(paths)
+        if paths:
+            print("reduced cases written to {}/".format(arguments.out))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,94 @@
 import pygame
-from pygame.constants import (QUIT, K_ESCAPE, KEYDOWN, KEYUP, K_UP, K_RIGHT, K_DOWN, K_LEFT, K_a, K_d, K_r, K_t, K_h, K_g, K_f, K_u, K_i, K_k, K_SPACE)
+from pygame.constants import (QUIT, K_ESCAPE, KEYDOWN, KEYUP, K_UP, K_RIGHT, K_DOWN, K_LEFT, K_a, K_d, K_r, K_t, K_h, K_g, K_f, K_u, K_i, K_k, K_SPACE, K_F3, K_BACKSPACE)
 import os
+import argparse
 import math
+import time
+import threading
+import json
+import gzip
+import pickle
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import struct
+import socket
+from array import array
+from collections import OrderedDict, deque
 from abc import ABC, abstractmethod
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#Wall-clock time in seconds, running speed times as fast as real time
+class RealClock(object):
+    def __init__(self, speed=1.0) -> None:
+        self.speed = speed
+        self.start = time.perf_counter()
+
+    def now(self):
+        return (time.perf_counter() - self.start) * self.speed
+
+    def sleep(self, seconds) -> None:
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+
+#Time that only moves when it is advanced. Sleeping advances it instead of waiting, so a game on it runs as fast as
+#it can and still sees the same times as in live play. Meant for one thread, a physics thread would advance it too
+class SimulatedClock(object):
+    #Its seconds stand for seconds of real time
+    speed = 1.0
+
+    def __init__(self, start=0.0) -> None:
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def advance(self, seconds) -> None:
+        self.time += seconds
+
+    def sleep(self, seconds) -> None:
+        if seconds > 0:
+            self.time += seconds
 
 
 class Settings(object):
     window = {'width': 800, 'height': 800}
     fps = 120
     deltatime = 1.0 / fps
+    #The game draws at fps and steps the physics at 1 / timestep, independent of how fast it draws
+    timestep = 1.0 / 480
+    substeps = 1
+    #Mixer buffer in samples. The default of 512 or more makes the flipper sound lag behind the key
+    audio_buffer = 256
+    #Longest lag the physics catches up on after a stall, the rest is dropped. In real time like the two below,
+    #so it is scaled by the speed of the clock
+    max_lag = 0.1
+    #How often the game looks for input while it waits for the next frame
+    input_poll = 0.001
+    #Game time for the game loop, timers and input timestamps
+    clock = RealClock()
+    physics_thread = False
+    #Show where the ball will go while the launcher charges
+    launch_preview = False
     title = "Pinball 45"
     path = {}
     path['file'] = os.path.dirname(os.path.abspath(__file__))
     path['image'] = os.path.join(path['file'], "images")
     path['sound'] = os.path.join(path['file'], 'sounds')
+    path['table'] = os.path.join(path['file'], 'tables')
+    layout = "classic.json"
     gameover = False
+    headless = False
+    collision = "mask"
+    dirty_rendering = False
+    grid_cell = 64
+    #Balls on the table at the start of a game. Every ball beyond the first is a MultiBall ball and needs numpy
+    balls = 1
 
     @staticmethod
     def dim():
@@ -27,26 +101,495 @@ class Settings(object):
     def soundpath(name):
         return os.path.join(Settings.path['sound'], name)
 
+    @staticmethod
+    def tablepath(name):
+        return os.path.join(Settings.path['table'], name)
+
+    @staticmethod
+    def bundlepath():
+        return os.path.join(Settings.path['file'], "assets-{}x{}.bundle".format(*Settings.dim()))
+
+    #Surfaces can only be converted once a video mode is set, which never happens headless
+    @staticmethod
+    def convert_alpha(surface):
+        if Settings.headless:
+            return surface
+        return surface.convert_alpha()
+
+    @staticmethod
+    def convert(surface):
+        if Settings.headless:
+            return surface
+        return surface.convert()
+
+
+#Stands in for pygame.mixer.Sound when there is no audio device
+class NullSound(object):
+    def play(self, *args, **kwargs) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    def set_volume(self, volume) -> None:
+        pass
+
+
+#Plays one sample, on the channels reserved for it if it has any, else on any free channel. A trigger within
+#min_interval of the last one is dropped, so mashing a key never stacks up more voices than the mixer can mix
+class Cue(object):
+    def __init__(self, sound, channels=(), min_interval=0.0) -> None:
+        self.sound = sound
+        self.channels = list(channels)
+        self.min_interval = min_interval
+        self.last = -math.inf
+        self.next_channel = 0
+
+    #Game time, so slow motion and simulated runs cap the sound the same way. A clock that went back, like a new
+    #SimulatedClock, starts the interval again
+    def play(self) -> None:
+        now = Settings.clock.now()
+        if 0 <= now - self.last < self.min_interval:
+            return
+        self.last = now
+        if not self.channels:
+            self.sound.play()
+            return
+        for channel in self.channels:
+            if not channel.get_busy():
+                channel.play(self.sound)
+                return
+        #All reserved channels are busy, the oldest voice is cut off
+        self.channels[self.next_channel].play(self.sound)
+        self.next_channel = (self.next_channel + 1) % len(self.channels)
+
+    def stop(self) -> None:
+        if self.channels:
+            for channel in self.channels:
+                channel.stop()
+        else:
+            self.sound.stop()
+
+    def set_volume(self, volume) -> None:
+        self.sound.set_volume(volume)
+
+
+#Every sound of the game, each sample loaded once. pre_init sets the small buffer, start then brings up the mixer
+#and reserves the channels. Without a mixer, or headless, every cue is a NullSound
+class SoundBank(object):
+    #Channel groups reserved at the start of the mixer, and how many channels each has
+    groups = {'flipper': 2, 'launcher': 1}
+    #Free channels for everything without a group
+    free_channels = 4
+    #Sample: (channel group, shortest time between two plays in seconds)
+    cues = {'flipper.wav': ('flipper', 0.03), 'launch.wav': ('launcher', 0.05), 'new_game.wav': ('launcher', 0.05)}
+    default_interval = 0.05
+    samples = {}
+    channels = {}
+    loaded = {}
+    running = False
+
+    @staticmethod
+    def pre_init() -> None:
+        pygame.mixer.pre_init(44100, -16, 2, Settings.audio_buffer)
+
+    @staticmethod
+    def start() -> None:
+        SoundBank.clear()
+        if Settings.headless:
+            return
+        try:
+            pygame.mixer.init()
+        except pygame.error:
+            return
+        reserved = sum(SoundBank.groups.values())
+        pygame.mixer.set_num_channels(reserved + SoundBank.free_channels)
+        pygame.mixer.set_reserved(reserved)
+        number = 0
+        for group, count in SoundBank.groups.items():
+            SoundBank.channels[group] = [pygame.mixer.Channel(number + index) for index in range(count)]
+            number += count
+        SoundBank.running = True
+
+    #Sounds and channels die with the mixer
+    @staticmethod
+    def clear() -> None:
+        SoundBank.samples.clear()
+        SoundBank.channels.clear()
+        SoundBank.loaded.clear()
+        SoundBank.running = False
+
+    #One cue per sample, shared by every object playing it, so the interval holds across them.
+    #A headless table in the same process as a game, or after pygame quit, stays silent
+    @staticmethod
+    def cue(name):
+        if not SoundBank.running or Settings.headless or not pygame.mixer.get_init():
+            return NullSound()
+        cue = SoundBank.loaded.get(name)
+        if cue is None:
+            if name not in SoundBank.samples:
+                sample = Assets.bundle.sound(name) if Assets.bundle else None
+                SoundBank.samples[name] = sample or pygame.mixer.Sound(Settings.soundpath(name))
+            group, interval = SoundBank.cues.get(name, (None, SoundBank.default_interval))
+            cue = Cue(SoundBank.samples[name], SoundBank.channels.get(group, ()), interval)
+            SoundBank.loaded[name] = cue
+        return cue
+
+
+#Process wide cache of images and masks. Images are keyed by (file, size, angle, flip, headless) and
+#derived from each other, so identical pieces share one Surface and Mask. Least recently used entries
+#are evicted once the cache holds more than memory_limit bytes
+class Assets(object):
+    entries = OrderedDict()
+    memory = 0
+    memory_limit = 64 * 1024 * 1024
+    #An AssetBundle to take prepared entries from instead of creating them
+    bundle = None
+
+    @staticmethod
+    def get(key, create, measure):
+        entry = Assets.entries.get(key)
+        if entry is not None:
+            Assets.entries.move_to_end(key)
+            return entry[0]
+        value = Assets.bundle.get(key) if Assets.bundle else None
+        if value is None:
+            value = create()
+        size = measure(value)
+        Assets.entries[key] = (value, size)
+        Assets.memory += size
+        while Assets.memory > Assets.memory_limit and len(Assets.entries) > 1:
+            _, (_, evicted) = Assets.entries.popitem(last=False)
+            Assets.memory -= evicted
+        return value
+
+    @staticmethod
+    def clear() -> None:
+        Assets.entries.clear()
+        Assets.memory = 0
+
+    #Numbers measured from an image are small next to it and count for nothing
+    @staticmethod
+    def value_size(value):
+        return 0
+
+    @staticmethod
+    def surface_size(surface):
+        return surface.get_pitch() * surface.get_height()
+
+    @staticmethod
+    def image(name, size=None, angle=0, flip=(False, False)):
+        key = ('image', name, size, angle % 360, tuple(flip), Settings.headless)
+        return Assets.get(key, lambda: Assets.create_image(name, size, angle % 360, tuple(flip)), Assets.surface_size)
+
+    @staticmethod
+    def create_image(name, size, angle, flip):
+        if angle:
+            return pygame.transform.rotate(Assets.image(name, size, 0, flip), angle)
+        if flip != (False, False):
+            return pygame.transform.flip(Assets.image(name, size), *flip)
+        if size is not None:
+            return Settings.convert_alpha(pygame.transform.scale(Assets.image(name), size))
+        return Settings.convert_alpha(pygame.image.load(Settings.imagepath(name)))
+
+    @staticmethod
+    def mask(name, size=None, angle=0, flip=(False, False)):
+        key = ('mask', name, size, angle % 360, tuple(flip))
+        return Assets.get(key, lambda: pygame.mask.from_surface(Assets.image(name, size, angle, flip)), Assets.mask_size)
+
+    @staticmethod
+    def mask_size(mask):
+        width, height = mask.get_size()
+        return width * height // 8
+
+    @staticmethod
+    def background():
+        key = ('background', Settings.dim(), Settings.headless)
+        return Assets.get(key, lambda: Settings.convert(pygame.transform.scale(pygame.image.load(Settings.imagepath("table.png")),
+                                                                               Settings.dim())), Assets.surface_size)
+
+
+#The surfaces, masks and sounds of the game for one window size in a single file, as the bytes of the surfaces and
+#mask bits and the PCM data of the sounds. Built once with "python pinball_45.py --build-bundle" on the machine that
+#runs the game. The game maps it into memory and copies the bytes into new surfaces, masks and sounds without decoding,
+#scaling or rotating. A bundle of another display or mixer format, or older than any image or sound, is not used
+class AssetBundle(object):
+    magic = b'P45A'
+    version = 2
+    header = struct.Struct('<4sBQ')
+
+    def __init__(self, path) -> None:
+        with open(path, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, length = AssetBundle.header.unpack_from(self.data)
+        if magic != AssetBundle.magic or version != AssetBundle.version:
+            raise ValueError("{} is not an asset bundle of this version".format(path))
+        start = AssetBundle.header.size
+        contents = pickle.loads(self.data[start:start + length])
+        self.display = contents['display']
+        self.mixer = contents['mixer']
+        self.sources = contents['sources']
+        self.index = contents['index']
+        self.view = memoryview(self.data)[start + length:]
+
+    #The bundle at Settings.bundlepath() if there is one that fits the display and the files, else None
+    @staticmethod
+    def open(screen):
+        try:
+            bundle = AssetBundle(Settings.bundlepath())
+        except (OSError, ValueError, EOFError, KeyError, pickle.UnpicklingError):
+            return None
+        if bundle.display != AssetBundle.display_format(screen) or bundle.sources != AssetBundle.source_files():
+            return None
+        return bundle
+
+    @staticmethod
+    def display_format(screen):
+        return (screen.get_size(), screen.get_bitsize(), screen.get_masks())
+
+    #Size and modification time of every image and sound
+    @staticmethod
+    def source_files():
+        sources = {}
+        for kind in ('image', 'sound'):
+            for name in sorted(os.listdir(Settings.path[kind])):
+                stat = os.stat(os.path.join(Settings.path[kind], name))
+                sources[(kind, name)] = (stat.st_mtime_ns, stat.st_size)
+        return sources
+
+    def get(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        kind, offset, length, size, layout = entry
+        if kind == 'value':
+            return layout
+        data = self.view[offset:offset + length]
+        if kind == 'surface':
+            flags, bitsize, masks, pitch = layout
+            surface = pygame.Surface(size, flags, bitsize, masks)
+            if surface.get_pitch() != pitch:
+                return None
+            memoryview(surface.get_buffer())[:] = data
+            return surface
+        mask = pygame.mask.Mask(size)
+        memoryview(mask).cast('B')[:] = data
+        return mask
+
+    def sound(self, name):
+        entry = self.index.get(('sound', name))
+        if entry is None or pygame.mixer.get_init() != self.mixer:
+            return None
+        kind, offset, length, size, layout = entry
+        return pygame.mixer.Sound(buffer=self.view[offset:offset + length])
+
+    #Loads every layout in tables/ and every sound like the game does and writes what ended up in the caches
+    @staticmethod
+    def build(path):
+        headless, memory_limit = Settings.headless, Assets.memory_limit
+        Settings.headless = False
+        Assets.bundle = None
+        Assets.memory_limit = math.inf
+        try:
+            return AssetBundle.write(path)
+        finally:
+            Game.quit()
+            Settings.headless, Assets.memory_limit = headless, memory_limit
+
+    @staticmethod
+    def write(path):
+        SoundBank.pre_init()
+        pygame.display.init()
+        pygame.font.init()
+        SoundBank.start()
+        screen = pygame.display.set_mode(Settings.dim())
+        Assets.clear()
+        Assets.background()
+        for layout in sorted(os.listdir(Settings.path['table'])):
+            if layout.endswith(".json"):
+                Table(layout)
+        for name in sorted(os.listdir(Settings.path['sound'])):
+            if name.endswith(".wav"):
+                SoundBank.cue(name)
+        index = {}
+        chunks = []
+        offset = 0
+        #The images at their original size are only the source of the scaled ones
+        entries = [(key, value) for key, (value, size) in Assets.entries.items() if key[:1] != ('image',) or key[2] is not None]
+        entries += [(('sound', name), sound) for name, sound in SoundBank.samples.items()]
+        for key, value in entries:
+            if isinstance(value, pygame.Surface):
+                data = value.get_buffer().raw
+                layout = (value.get_flags() & pygame.SRCALPHA, value.get_bitsize(), value.get_masks(), value.get_pitch())
+                index[key] = ('surface', offset, len(data), value.get_size(), layout)
+            elif isinstance(value, pygame.mask.Mask):
+                data = bytes(memoryview(value))
+                index[key] = ('mask', offset, len(data), value.get_size(), None)
+            elif isinstance(value, (int, tuple)):
+                index[key] = ('value', offset, 0, None, value)
+                continue
+            else:
+                data = value.get_raw()
+                index[key] = ('sound', offset, len(data), None, None)
+            chunks.append(data)
+            offset += len(data)
+        contents = pickle.dumps({'display': AssetBundle.display_format(screen), 'mixer': pygame.mixer.get_init(),
+                                 'sources': AssetBundle.source_files(), 'index': index}, pickle.HIGHEST_PROTOCOL)
+        with open(path, 'wb') as file:
+            file.write(AssetBundle.header.pack(AssetBundle.magic, AssetBundle.version, len(contents)))
+            file.write(contents)
+            for data in chunks:
+                file.write(data)
+        return len(index), offset
+
+
+#Stands in for an EventLog when no events are written
+class NullEventLog(object):
+    def emit(self, kind, **fields) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+#Streams game events as gzip compressed JSON lines. emit() only appends to a bounded buffer and a background thread
+#writes it out in batches, so the game never waits for a slow disk. While the buffer is full new events are dropped
+#and counted, and the writer records how many of each kind were lost. A file is closed after max_bytes of events
+#and only the newest keep files are kept
+class EventLog(object):
+    def __init__(self, directory, capacity=8192, batch=256, interval=1.0, max_bytes=8 * 1024 * 1024, keep=8) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.capacity = capacity
+        self.batch = batch
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.buffer = deque()
+        #The game thread counts drops and the writer takes the counts, both only while holding the lock
+        self.dropped = {}
+        self.dropped_lock = threading.Lock()
+        self.file = None
+        self.written = 0
+        self.files = 0
+        self.running = True
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.write, name="events", daemon=True)
+        self.thread.start()
+
+    def emit(self, kind, **fields) -> None:
+        if len(self.buffer) >= self.capacity:
+            with self.dropped_lock:
+                self.dropped[kind] = self.dropped.get(kind, 0) + 1
+            return
+        fields['event'] = kind
+        fields['time'] = time.time()
+        self.buffer.append(fields)
+        if len(self.buffer) >= self.batch:
+            self.wake.set()
+
+    #Writes what is left and stops the writer
+    def close(self) -> None:
+        self.running = False
+        self.wake.set()
+        self.thread.join()
 
-#Displaying Text
+    def write(self) -> None:
+        while self.running:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+        self.flush()
+        if self.file:
+            self.file.close()
+
+    #Writes the buffer a batch at a time. Between batches the writer sleeps for a moment, so it hands the GIL back to
+    #the game instead of holding it until the interpreter takes it away
+    def flush(self) -> None:
+        while self.buffer or self.dropped:
+            lines = []
+            while self.buffer and len(lines) < self.batch:
+                lines.append(json.dumps(self.buffer.popleft(), separators=(',', ':')))
+            if not self.buffer and self.dropped:
+                with self.dropped_lock:
+                    dropped, self.dropped = self.dropped, {}
+                lines.append(json.dumps({'event': "dropped", 'time': time.time(), 'counts': dropped}, separators=(',', ':')))
+            data = ("\n".join(lines) + "\n").encode()
+            if self.file is None or self.written >= self.max_bytes:
+                self.rotate()
+            self.file.write(data)
+            self.written += len(data)
+            time.sleep(0)
+        #A sync flush keeps everything written so far readable even if the game is killed
+        if self.file:
+            self.file.flush()
+
+    def rotate(self) -> None:
+        if self.file:
+            self.file.close()
+        self.files += 1
+        name = "events-{}-{:04d}.jsonl.gz".format(time.strftime("%Y%m%d-%H%M%S"), self.files)
+        self.file = gzip.open(os.path.join(self.directory, name), 'wb')
+        self.written = 0
+        logs = sorted(name for name in os.listdir(self.directory) if name.startswith("events-") and name.endswith(".jsonl.gz"))
+        for old in logs[:-self.keep]:
+            os.remove(os.path.join(self.directory, old))
+
+
+#Displaying Text. The text is only rendered when it is drawn and has changed since, and rendered texts are shared
 class Display(pygame.sprite.Sprite):
-    def __init__(self, pos_x, pos_y, text) -> None:
+    fonts = {}
+    rendered = OrderedDict()
+    cache_size = 256
+
+    def __init__(self, pos_x, pos_y, text, fontsize=24) -> None:
         super().__init__()
         self.pos_x = pos_x
         self.pos_y = pos_y
-        self.fontsize = 24
+        self.fontsize = fontsize
         self.fontfamily = pygame.font.get_default_font()
         self.fontcolor = [255, 255, 255]
-        self.font = pygame.font.Font(self.fontfamily, self.fontsize)
+        self.text = None
         self.render_text(text)
         self.pos_x = pos_x
         self.pos_y = pos_y
         self.generate_rect()
 
+    @staticmethod
+    def font(family, size):
+        key = (family, size)
+        if key not in Display.fonts:
+            Display.fonts[key] = pygame.font.Font(family, size)
+        return Display.fonts[key]
+
+    #Least recently used cache of rendered texts
+    def render(self, text):
+        if Settings.headless:
+            return pygame.Surface((0, 0))
+        key = (text, self.fontfamily, self.fontsize, tuple(self.fontcolor))
+        surface = Display.rendered.get(key)
+        if surface is None:
+            surface = Display.font(self.fontfamily, self.fontsize).render(text, True, self.fontcolor)
+            Display.rendered[key] = surface
+            if len(Display.rendered) > Display.cache_size:
+                Display.rendered.popitem(last=False)
+        else:
+            Display.rendered.move_to_end(key)
+        return surface
+
     def render_text(self, text) -> None:
-        if not isinstance(text, str):
-            text = str(text)
-        self.rendered_text = self.font.render(text, True, self.fontcolor)
+        if text != self.text:
+            self.text = text
+            self.surface = None
+
+    @property
+    def rendered_text(self):
+        if self.surface is None:
+            text = self.text
+            if not isinstance(text, str):
+                text = str(text)
+            self.surface = self.render(text)
+        return self.surface
 
     def generate_rect(self) -> None:
         self.rect = self.rendered_text.get_rect()
@@ -56,6 +599,10 @@ class Display(pygame.sprite.Sprite):
     def update(self, text) -> None:
         self.render_text(text)
 
+    @property
+    def image(self):
+        return self.rendered_text
+
     def draw(self, screen) -> None:
         screen.blit(self.rendered_text, self.rect)
 
@@ -66,10 +613,12 @@ class Score(pygame.sprite.Sprite):
         self.pos_y = pos_y
         self.points = 0
         self.scoredisplay = Display(pos_x, pos_y, self.points)
+        self.events = NullEventLog()
 
     def add_points(self, points) -> None:
         self.points += points
         self.scoredisplay.update(self.points)
+        self.events.emit("score", points=points, total=self.points)
 
     def reset(self) -> None:
         self.points = 0
@@ -81,16 +630,21 @@ class Score(pygame.sprite.Sprite):
 
 #Returns if a certain time has passed
 class Timer(object):
-    def __init__(self, duration, with_start = True) -> None:
+    def __init__(self, duration, with_start = True, clock=None) -> None:
         self.duration = duration
+        self.clock = clock or Settings.clock
         if with_start:
-            self.next = pygame.time.get_ticks()
+            self.next = self.ticks()
         else:
-            self.next = pygame.time.get_ticks() + self.duration
+            self.next = self.ticks() + self.duration
+
+    #Milliseconds on the clock, like pygame.time.get_ticks
+    def ticks(self):
+        return int(self.clock.now() * 1000)
 
     def is_next_stop_reached(self):
-        if pygame.time.get_ticks() > self.next:
-            self.next = pygame.time.get_ticks() + self.duration
+        if self.ticks() > self.next:
+            self.next = self.ticks() + self.duration
             return True
         return False
 
@@ -100,6 +654,228 @@ class Timer(object):
             self.duration = 0
 
 
+#Stands in for the Profiler when profiling is off, so the game only pays for the empty method calls
+class NullProfiler(object):
+    def start_frame(self) -> None:
+        pass
+
+    def mark(self, phase) -> None:
+        pass
+
+    def count(self, amount=1) -> None:
+        pass
+
+    def end_frame(self) -> None:
+        pass
+
+
+#Times the phases of every frame. Each mark() adds the time since the previous mark to its phase, so the phases
+#follow each other without gaps. The last frames and spans are kept in ring buffers, frame times also in a histogram
+class Profiler(object):
+    phases = ['events', 'flippers', 'ball', 'launcher', 'launcher_collision', 'walls', 'rails', 'flipper_collision',
+              'out_of_table', 'multiball', 'draw_background', 'draw_launcher', 'draw_displays', 'draw_walls', 'draw_flippers',
+              'draw_rails', 'draw_score', 'draw_ball', 'draw_multiball', 'draw_dirty', 'draw_overlay', 'flip']
+    histogram_ms = 32
+
+    def __init__(self, frames=1024, spans=65536) -> None:
+        self.clock = time.perf_counter_ns
+        self.index = {phase: index for index, phase in enumerate(Profiler.phases)}
+        self.capacity = frames
+        self.times = [array('d', [0.0]) * frames for _ in Profiler.phases]
+        self.work = array('d', [0.0]) * frames
+        self.intervals = array('d', [0.0]) * frames
+        self.collision_counts = array('L', [0]) * frames
+        self.frame_ends = array('q', [0]) * frames
+        self.histogram = array('L', [0]) * (Profiler.histogram_ms + 1)
+        self.span_capacity = spans
+        self.spans = array('q', [0]) * (3 * spans)
+        self.span = 0
+        self.frames = 0
+        self.overruns = 0
+        self.current = [0] * len(Profiler.phases)
+        self.collisions = 0
+        self.origin = self.clock()
+        self.frame_start = self.origin
+        self.last = self.origin
+        self.previous_end = None
+
+    def start_frame(self) -> None:
+        self.frame_start = self.last = self.clock()
+        self.current = [0] * len(Profiler.phases)
+        self.collisions = 0
+
+    def mark(self, phase) -> None:
+        now = self.clock()
+        index = self.index[phase]
+        self.current[index] += now - self.last
+        slot = 3 * (self.span % self.span_capacity)
+        self.spans[slot] = index
+        self.spans[slot + 1] = self.last - self.origin
+        self.spans[slot + 2] = now - self.last
+        self.span += 1
+        self.last = now
+
+    def count(self, amount=1) -> None:
+        self.collisions += amount
+
+    #A frame overruns when its work alone takes longer than one frame at Settings.fps.
+    #The interval between the ends of two frames is what the player sees and goes into the histogram
+    def end_frame(self) -> None:
+        now = self.clock()
+        slot = self.frames % self.capacity
+        for index, duration in enumerate(self.current):
+            self.times[index][slot] = duration / 1e6
+        work = (now - self.frame_start) / 1e6
+        interval = (now - self.previous_end) / 1e6 if self.previous_end else work
+        self.work[slot] = work
+        self.intervals[slot] = interval
+        self.collision_counts[slot] = self.collisions
+        self.frame_ends[slot] = now - self.origin
+        self.histogram[min(int(interval), Profiler.histogram_ms)] += 1
+        if work > 1000 / Settings.fps:
+            self.overruns += 1
+        self.previous_end = now
+        self.frames += 1
+
+    #Slots of the frames still in the ring buffer, oldest first
+    def slots(self):
+        count = min(self.frames, self.capacity)
+        return [frame % self.capacity for frame in range(self.frames - count, self.frames)]
+
+    @staticmethod
+    def percentile(samples, fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    #Averages over the frames in the ring buffer. Times are in milliseconds
+    def summary(self):
+        slots = self.slots()
+        if not slots:
+            return None
+        intervals = sorted(self.intervals[slot] for slot in slots)
+        mean_interval = sum(intervals) / len(intervals)
+        phases = {phase: sum(self.times[index][slot] for slot in slots) / len(slots) for index, phase in enumerate(Profiler.phases)}
+        collisions = [self.collision_counts[slot] for slot in slots]
+        return {'frames': self.frames, 'fps': 1000 / mean_interval if mean_interval else 0.0,
+                'work': sum(self.work[slot] for slot in slots) / len(slots),
+                'p50': Profiler.percentile(intervals, 0.50), 'p95': Profiler.percentile(intervals, 0.95),
+                'p99': Profiler.percentile(intervals, 0.99), 'max': intervals[-1], 'overruns': self.overruns,
+                'collisions': sum(collisions) / len(collisions), 'max_collisions': max(collisions), 'phases': phases}
+
+    #Writes the spans and per frame counters in the Trace Event Format, which chrome://tracing and Perfetto open
+    def export(self, path) -> None:
+        events = []
+        count = min(self.span, self.span_capacity)
+        for span in range(self.span - count, self.span):
+            slot = 3 * (span % self.span_capacity)
+            index, start, duration = self.spans[slot:slot + 3]
+            phase = Profiler.phases[index]
+            category = "draw" if phase.startswith("draw") or phase == "flip" else "update"
+            events.append({'name': phase, 'cat': category, 'ph': "X", 'ts': start / 1000, 'dur': duration / 1000, 'pid': 0, 'tid': 0})
+        for slot in self.slots():
+            events.append({'name': "frame", 'ph': "C", 'ts': self.frame_ends[slot] / 1000, 'pid': 0, 'tid': 0,
+                           'args': {'interval_ms': self.intervals[slot], 'collisions': self.collision_counts[slot]}})
+        data = {'traceEvents': events, 'displayTimeUnit': "ms",
+                'otherData': {'frames': self.frames, 'overruns': self.overruns, 'histogram_ms': list(self.histogram)}}
+        with open(path, 'w') as file:
+            json.dump(data, file)
+
+
+#Measures how long a flipper key takes to change the flipper and to reach the screen. The physics calls applied() when
+#it applies a key, the game moves the keys applied so far into its frame with capture() and calls presented() after
+#the flip. Only the ring buffers of the last samples are kept
+class LatencyMeter(object):
+    keys = (K_a, K_d)
+
+    def __init__(self, samples=1024, clock=None) -> None:
+        self.clock = clock or Settings.clock
+        self.capacity = samples
+        self.to_flipper = array('d', [0.0]) * samples
+        self.to_screen = array('d', [0.0]) * samples
+        self.samples = 0
+        self.pending = []
+        self.captured = []
+
+    def applied(self, timestamp, key) -> None:
+        if key in LatencyMeter.keys:
+            self.pending.append((timestamp, self.clock.now()))
+
+    def capture(self) -> None:
+        self.captured += self.pending
+        self.pending = []
+
+    def presented(self) -> None:
+        now = self.clock.now()
+        for timestamp, applied in self.captured:
+            slot = self.samples % self.capacity
+            self.to_flipper[slot] = (applied - timestamp) * 1000
+            self.to_screen[slot] = (now - timestamp) * 1000
+            self.samples += 1
+        self.captured = []
+
+    #Percentiles of both latencies in milliseconds
+    def summary(self):
+        count = min(self.samples, self.capacity)
+        if not count:
+            return None
+        summary = {'samples': self.samples}
+        for name, samples in (('flipper', self.to_flipper), ('screen', self.to_screen)):
+            ordered = sorted(samples[:count])
+            summary[name] = {'p50': Profiler.percentile(ordered, 0.50), 'p95': Profiler.percentile(ordered, 0.95),
+                             'p99': Profiler.percentile(ordered, 0.99), 'max': ordered[-1]}
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if summary is None:
+            return "input latency: no flipper keys yet"
+        return "\n".join("key to {:7} p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  max {:.1f} ms".format(
+            name, summary[name]['p50'], summary[name]['p95'], summary[name]['p99'], summary[name]['max'])
+            for name in ('flipper', 'screen'))
+
+
+#Profiler statistics as lines of text in the top left corner, refreshed twice a second
+class ProfilerOverlay(object):
+    def __init__(self, profiler, latency=None, pos_x=10, pos_y=10, lines=8) -> None:
+        self.profiler = profiler
+        self.latency = latency
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+        self.lines = [Display(pos_x, pos_y, "", 16) for _ in range(lines)]
+        self.timer = Timer(500)
+        self.refresh()
+
+    def texts(self):
+        summary = self.profiler.summary()
+        if summary is None:
+            return ["profiler: no frames yet"]
+        texts = ["{:.1f} fps  frame p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  max {:.1f} ms".format(
+                     summary['fps'], summary['p50'], summary['p95'], summary['p99'], summary['max']),
+                 "work {:.2f} ms  overruns {} of {}".format(summary['work'], summary['overruns'], summary['frames']),
+                 "collisions {:.1f} per frame, max {}".format(summary['collisions'], summary['max_collisions'])]
+        latency = self.latency.summary() if self.latency else None
+        if latency:
+            texts.append("key to flipper p95 {:.1f} ms  to screen p50 {:.1f}  p95 {:.1f} ms".format(
+                latency['flipper']['p95'], latency['screen']['p50'], latency['screen']['p95']))
+        slowest = sorted(summary['phases'].items(), key=lambda phase: phase[1], reverse=True)
+        for phase, duration in slowest[:len(self.lines) - len(texts)]:
+            texts.append("{} {:.3f} ms".format(phase, duration))
+        return texts
+
+    def refresh(self) -> None:
+        texts = self.texts()
+        for index, line in enumerate(self.lines):
+            line.update(texts[index] if index < len(texts) else "")
+            line.rect = line.rendered_text.get_rect(topleft=(self.pos_x, self.pos_y + index * (line.fontsize + 2)))
+
+    def update(self) -> None:
+        if self.timer.is_next_stop_reached():
+            self.refresh()
+
+    def draw(self, screen) -> None:
+        for line in self.lines:
+            line.draw(screen)
+
+
 #Every object on the table
 class TableObject(pygame.sprite.Sprite, ABC):
     def __init__(self, pos_x, pos_y, width, height, image_name) -> None:
@@ -110,27 +886,23 @@ class TableObject(pygame.sprite.Sprite, ABC):
         self.height = height
         self.image_name = image_name
         self.sound = []
-        self.load_image()
         self.scale_image()
         self.rect = self.image.get_rect()
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = Assets.mask(self.image_name, self.size)
         self.rect_topleft()
 
-    def load_image(self) -> None:
-        self.image = pygame.image.load(Settings.imagepath(self.image_name)).convert_alpha()
-
     def scale_image(self) -> None:
-        self.image = pygame.transform.scale(self.image, (self.width, self.height)).convert_alpha()
+        self.size = (self.width, self.height)
+        self.image = Assets.image(self.image_name, self.size)
 
     def rotate_image(self, angle) -> None:
-        self.image_template = self.image
-        self.image = pygame.transform.rotate(self.image_template, angle)
+        self.image = Assets.image(self.image_name, self.size, angle)
         self.rect = self.image.get_rect()
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = Assets.mask(self.image_name, self.size, angle)
         self.rect_topleft()
 
     def flip_image(self, on_x, on_y) -> None:
-        self.image = pygame.transform.flip(self.image_template, on_x, on_y)
+        self.image = Assets.image(self.image_name, self.size, 0, (on_x, on_y))
 
     def rect_center(self) -> None:
         self.rect.center = (self.pos_x, self.pos_y)
@@ -142,7 +914,7 @@ class TableObject(pygame.sprite.Sprite, ABC):
         self.rect.topright = (self.pos_x, self.pos_y)
 
     def load_sound(self, sound_name):
-        return pygame.mixer.Sound((Settings.soundpath(sound_name)))
+        return SoundBank.cue(sound_name)
 
 
 #Ball on the Pinball-table
@@ -151,15 +923,43 @@ class Ball(TableObject):
         super().__init__(pos_x, pos_y, width, height, image_name)
         self.rect_center()
         self.pos = pygame.Vector2(self.rect.centerx, self.rect.centery)
+        self.previous = pygame.Vector2(self.pos)
+        self.placed = self.rect.center
         self.direction = pygame.Vector2(0, 0)
         self.gravity = 281
+        self.radius = width / 2
 
-    def update(self) -> None:
-        self.direction[1] = self.direction[1] + self.gravity * Settings.deltatime
-        self.pos[0] = self.direction[0] * Settings.deltatime
-        self.pos[1] = self.direction[1] * Settings.deltatime
-        self.rect.centerx += round(self.pos[0])
-        self.rect.centery += round(self.pos[1])
+    #The sub-pixel position is kept in self.pos. Other objects place the ball through its rect, which is picked up here
+    def sync_position(self) -> None:
+        if self.rect.center != self.placed:
+            self.pos.update(self.rect.center)
+            self.placed = self.rect.center
+
+    def move_to(self, pos) -> None:
+        self.pos.update(pos)
+        self.rect.center = (round(self.pos[0]), round(self.pos[1]))
+        self.placed = self.rect.center
+
+    #Keeps the position before a physics step to draw the ball between the last two steps
+    def remember(self) -> None:
+        self.sync_position()
+        self.previous.update(self.pos)
+
+    #Rect at alpha of the way from the previous to the current position. A ball placed by another object jumps there
+    def interpolated_rect(self, alpha):
+        if self.rect.center != self.placed:
+            return self.rect
+        x = self.previous[0] + (self.pos[0] - self.previous[0]) * alpha
+        y = self.previous[1] + (self.pos[1] - self.previous[1]) * alpha
+        return self.rect.move(round(x) - self.rect.centerx, round(y) - self.rect.centery)
+
+    def accelerate(self, deltatime) -> None:
+        self.direction[1] = self.direction[1] + self.gravity * deltatime
+
+    def update(self, deltatime) -> None:
+        self.sync_position()
+        self.accelerate(deltatime)
+        self.move_to(self.pos + self.direction * deltatime)
 
 
 class TableObjectFixed(TableObject, ABC):
@@ -174,9 +974,16 @@ class TableObjectFixed(TableObject, ABC):
 
 #Walls of the table to keep the ball inside
 class Wall(TableObjectFixed, ABC):
+    angle = 0
+    anchor = 'topleft'
+    preserved_energy = 0.9
+    rail = False
+    index = None
+
     def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
         super().__init__(pos_x, pos_y, width, height, image_name, ball)
-        self.preserved_energy = 0.9
+        self.rotate_image(self.angle)
+        getattr(self, 'rect_' + self.anchor)()
 
     @abstractmethod
     def control_ball(self) -> None:
@@ -190,9 +997,7 @@ class Wall(TableObjectFixed, ABC):
 
 #Vertical Wall
 class WallV(Wall):
-    def __init__(self, pos_x, pos_y, width, size, image_name, ball) -> None:
-        super().__init__(pos_x, pos_y, width, size, image_name, ball)
-        self.rotate_image(0)
+    axis = (0, 1)
 
     def control_ball(self) -> None:
         super(WallV, self).control_ball()
@@ -208,9 +1013,8 @@ class WallV(Wall):
 
 #Horizontal Wall
 class WallH(Wall):
-    def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
-        super().__init__(pos_x, pos_y, width, height, image_name, ball)
-        self.rotate_image(90)
+    angle = 90
+    axis = (1, 0)
 
     def control_ball(self) -> None:
         super(WallH, self).control_ball()
@@ -226,9 +1030,8 @@ class WallH(Wall):
 
 #Diagonal Wall top to bottom
 class WallDTB(Wall):
-    def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
-        super().__init__(pos_x, pos_y, width, height, image_name, ball)
-        self.rotate_image(45)
+    angle = 45
+    axis = (math.sqrt(0.5), math.sqrt(0.5))
 
     def control_ball(self) -> None:
         super(WallDTB, self).control_ball()
@@ -242,10 +1045,9 @@ class WallDTB(Wall):
 
 #Diagonal Wall bottom to top
 class WallDBT(Wall):
-    def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
-        super().__init__(pos_x, pos_y, width, height, image_name, ball)
-        self.rotate_image(315)
-        self.rect_topright()
+    angle = 315
+    anchor = 'topright'
+    axis = (math.sqrt(0.5), -math.sqrt(0.5))
 
     def control_ball(self) -> None:
         super(WallDBT, self).control_ball()
@@ -260,79 +1062,152 @@ class WallDBT(Wall):
 class Flipper(TableObjectFixed, ABC):
     def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
         super().__init__(pos_x, pos_y, width, height, image_name, ball)
-        self.image_template = self.image
         self.sound = self.load_sound("flipper.wav")
+        self.rest_angle = 45
+        self.active_angle = -45
+        self.angular_speed = 900
+        self.frame_count = 19
+        self.restitution = 0.5
+        self.angle = self.rest_angle
+        self.target = self.rest_angle
+        self.angular_velocity = 0
+        self.generate_rect()
+        self.pivot = pygame.Vector2(self.rect.topleft) + self.local_pivot()
+        self.reach = self.image_reach()
+        self.frames = [self.build_frame(self.frame_angle(index)) for index in range(self.frame_count)]
+        #All frames share a square around the pivot, large enough for the image in any pose
+        self.rect = pygame.Rect(round(self.pivot[0]) - self.reach, round(self.pivot[1]) - self.reach, self.reach * 2, self.reach * 2)
+        self.show_frame()
 
     def generate_rect(self) -> None:
         self.rect.left = self.pos_x
         self.rect.centery = self.pos_y
 
     @abstractmethod
+    def local_pivot(self):
+        pass
+
+    #Unit vector from the pivot to the tip. Angles grow clockwise on the screen
+    def heading(self, angle):
+        return pygame.Vector2(self.side * math.cos(math.radians(angle)), math.sin(math.radians(angle)))
+
+    def frame_angle(self, index):
+        return self.rest_angle + (self.active_angle - self.rest_angle) * index / (self.frame_count - 1)
+
+    def side_image(self):
+        return Assets.image(self.image_name, self.size, flip=(self.side < 0, False))
+
+    #Distance from the pivot to the farthest corner of the drawn part of the image
+    def image_reach(self):
+        return Assets.get(('flipper reach', self.image_name, self.size, self.side), self.measure_reach, Assets.value_size)
+
+    def measure_reach(self):
+        pivot = self.local_pivot()
+        reach = 0
+        for rect in pygame.mask.from_surface(self.side_image()).get_bounding_rects():
+            for corner in (rect.topleft, rect.topright, rect.bottomleft, rect.bottomright):
+                reach = max(reach, (pygame.Vector2(corner) - pivot).length())
+        return math.ceil(reach)
+
+    def build_frame(self, angle):
+        key = (self.image_name, self.size, self.side, angle)
+        image = Assets.get(('flipper frame',) + key, lambda: self.draw_frame(angle), Assets.surface_size)
+        mask = Assets.get(('flipper mask',) + key, lambda: pygame.mask.from_surface(image), Assets.mask_size)
+        tip, radius = Assets.get(('flipper bar',) + key, lambda: self.measure_bar(image, angle), Assets.value_size)
+        return image, mask, FlipperSegment(self.pivot, self.pivot + self.heading(angle) * (tip - radius), radius, self)
+
+    #The segment follows the bar of the frame: it runs from the pivot along the heading to the tip of the bar,
+    #with the radius that gives it the area of the bar. Both are measured from the pivot, so they hold for a
+    #flipper of this image anywhere on the table
+    def measure_bar(self, image, angle):
+        heading = self.heading(angle)
+        center = pygame.Vector2(self.reach, self.reach)
+        middle = center + heading * self.reach / 2
+        bar = pygame.mask.from_threshold(image, image.get_at((int(middle[0]), int(middle[1]))), (40, 40, 40, 255))
+        tip = max((pygame.Vector2(point) - center).dot(heading) for point in bar.outline())
+        area = bar.count()
+        return tip, (math.sqrt(tip * tip + (math.pi - 2) * area) - tip) / (math.pi - 2)
+
+    #The image shows the flipper at rest, its bar pointing away from the pivot. A frame turns it about the pivot,
+    #which stays in the centre of the frame
+    def draw_frame(self, angle):
+        pivot = self.local_pivot()
+        canvas = pygame.Surface((self.reach * 2, self.reach * 2), pygame.SRCALPHA)
+        canvas.blit(self.side_image(), (self.reach - pivot[0], self.reach - pivot[1]))
+        rotated = pygame.transform.rotate(canvas, (self.rest_angle - angle) * self.side)
+        frame = pygame.Surface(canvas.get_size(), pygame.SRCALPHA)
+        frame.blit(rotated, rotated.get_rect(center=(self.reach, self.reach)))
+        return Settings.convert_alpha(frame)
+
+    def show_frame(self) -> None:
+        index = round((self.angle - self.rest_angle) / (self.active_angle - self.rest_angle) * (self.frame_count - 1))
+        self.image, self.mask, self.segment = self.frames[index]
+
     def move(self) -> None:
         self.sound.play()
+        self.target = self.active_angle
 
-    @abstractmethod
     def move_back(self) -> None:
-        pass
+        self.target = self.rest_angle
+
+    def update(self, deltatime) -> None:
+        if self.angle == self.target:
+            self.angular_velocity = 0
+            return
+        previous = self.angle
+        if self.angle < self.target:
+            self.angle = min(self.target, self.angle + self.angular_speed * deltatime)
+        elif self.angle > self.target:
+            self.angle = max(self.target, self.angle - self.angular_speed * deltatime)
+        self.angular_velocity = (self.angle - previous) / deltatime
+        if self.angle != previous:
+            self.show_frame()
+
+    def surface_velocity(self, point):
+        offset = point - self.pivot
+        return pygame.Vector2(-offset[1], offset[0]) * (math.radians(self.angular_velocity) * self.side)
+
+    #Reflects the ball relative to the moving surface, so a swinging flipper hits it
+    def bounce(self, ball, normal) -> None:
+        surface = self.surface_velocity(ball.pos - normal * ball.radius)
+        approach = (ball.direction - surface).dot(normal)
+        if approach < 0:
+            ball.direction = ball.direction - normal * approach * (1 + self.restitution)
 
-    @abstractmethod
-    def control_ball(self):
-        pass
+    def control_ball(self) -> None:
+        ball = self.ball.sprite
+        ball.sync_position()
+        contact = self.segment.contact(ball.pos, ball.radius, ball.direction)
+        if contact:
+            normal, depth = contact
+            self.bounce(ball, normal)
+            ball.move_to(ball.pos + normal * depth)
 
 
 class LeftFlipper(Flipper):
-    def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
-        super().__init__(pos_x, pos_y, width, height, image_name, ball)
-        self.generate_rect()
-   
-    def move(self) -> None:
-        super(LeftFlipper, self).move()
-        self.flip_image(False, True)
+    side = 1
 
-    def move_back(self) -> None:
-        self.flip_image(False, False)
+    def local_pivot(self):
+        return pygame.Vector2(0, self.size[1] / 2)
 
-    def control_ball(self) -> None:
-        if self.ball.sprite.rect.centerx > self.rect.centerx:
-            self.ball.sprite.direction[0] += 100
-        else:
-            self.ball.sprite.direction[0] -= 100
-        self.ball.sprite.direction[1] = -800
-    
 
 class RightFlipper(Flipper):
-    def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
-        super().__init__(pos_x, pos_y, width, height, image_name, ball)
-        self.flip_image(True, False)   
-        self.generate_rect()
-        
-    def move(self) -> None:
-        super(RightFlipper, self).move()
-        self.flip_image(True, True)
-
-    def move_back(self) -> None:
-        self.flip_image(True, False)
+    side = -1
 
-    def control_ball(self) -> None:
-        if self.ball.sprite.rect.centerx > self.rect.centerx:
-            self.ball.sprite.direction[0] -= 100
-        else:
-            self.ball.sprite.direction[0] += 100
-        self.ball.sprite.direction[1] = -800
+    def local_pivot(self):
+        return pygame.Vector2(self.size[0], self.size[1] / 2)
 
 
 class RailDTB(WallDTB):
-    def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
-        super().__init__(pos_x, pos_y, width, height, image_name, ball)
-    
+    rail = True
+
     def control_ball(self) -> None:
         y = (self.ball.sprite.rect.centery - self.rect.centery) - (self.ball.sprite.rect.centerx - self.rect.centerx)
         self.ball.sprite.rect.centerx += y
 
 
 class RailDBT(WallDBT):
-    def __init__(self, pos_x, pos_y, width, height, image_name, ball) -> None:
-        super().__init__(pos_x, pos_y, width, height, image_name, ball)
+    rail = True
 
     def control_ball(self) -> None:
         y = (self.ball.sprite.rect.centery - self.rect.centery) + (self.ball.sprite.rect.centerx - self.rect.centerx)
@@ -374,14 +1249,15 @@ class ChargedLauncher(Launcher):
         self.force = 0
         self.controlling = False
         self.ball_number = 0
+        self.events = NullEventLog()
         self.new_game_sound.play()
         self.display = display
         self.display.update("Hold Space and release")
         self.display_small = Display(self.pos_x, self.pos_y - 100, self.ball_number)
 
-    def update(self) -> None:
+    def update(self, deltatime) -> None:
         if self.charging and self.force <= 3000:
-            self.force += self.charge_speed * Settings.deltatime
+            self.force += self.charge_speed * deltatime
 
     def reset(self) -> None:
         self.ball_number = 0
@@ -401,9 +1277,10 @@ class ChargedLauncher(Launcher):
             self.display.update("Gameover Press R to restart")
 
     def control_ball(self) -> None:
-        self.ball.sprite.direction[1] = 0
-        self.ball.sprite.rect.centerx = self.pos_x
-        self.ball.sprite.rect.bottom = self.pos_y
+        ball = self.ball.sprite
+        ball.direction[1] = 0
+        ball.rect.centerx = self.pos_x
+        ball.rect.bottom = self.pos_y
 
     def charge(self) -> None:
         self.charging = True
@@ -412,6 +1289,7 @@ class ChargedLauncher(Launcher):
         self.launch_sound.play()
         self.display.update("")
         if self.controlling:
+            self.events.emit("launch", ball=self.ball_number, force=round(self.force, 1))
             super().launch_ball()
             self.position_ball_launch()
         self.charging = False
@@ -483,106 +1361,906 @@ class DebugLauncher(Launcher):
         self.rect.center = (self.pos_x, self.pos_y)
 
 
+#Straight piece of a wall or rail with a thickness of 2 * radius. All pieces are vertical, horizontal or 45 degrees
+class Segment(ABC):
+    points = 0
+    index = None
+
+    #The collision tests run on the plain floats, the vectors are kept for the callers
+    def __init__(self, start, end, radius) -> None:
+        self.start = pygame.Vector2(start)
+        self.end = pygame.Vector2(end)
+        self.radius = radius
+        self.vector = self.end - self.start
+        self.length_sq = self.vector.length_squared()
+        self.normal = pygame.Vector2(-self.vector[1], self.vector[0]).normalize()
+        self.left = min(self.start[0], self.end[0]) - radius
+        self.right = max(self.start[0], self.end[0]) + radius
+        self.top = min(self.start[1], self.end[1]) - radius
+        self.bottom = max(self.start[1], self.end[1]) + radius
+        self.start_x, self.start_y = self.start
+        self.end_x, self.end_y = self.end
+        self.vector_x, self.vector_y = self.vector
+        self.normal_x, self.normal_y = self.normal
+
+    #Returns the contact normal and penetration depth of a circle, or None if it does not touch
+    def contact(self, center, radius, direction):
+        touch = self.touch(center[0], center[1], radius, direction[0], direction[1])
+        if touch is None:
+            return None
+        return pygame.Vector2(touch[0], touch[1]), touch[2]
+
+    #contact() on floats, as (normal x, normal y, depth)
+    def touch(self, x, y, radius, direction_x, direction_y):
+        if x + radius <= self.left or x - radius >= self.right or y + radius <= self.top or y - radius >= self.bottom:
+            return None
+        vector_x = self.vector_x
+        vector_y = self.vector_y
+        t = ((x - self.start_x) * vector_x + (y - self.start_y) * vector_y) / self.length_sq
+        if t < 0:
+            t = 0
+        elif t > 1:
+            t = 1
+        offset_x = x - (self.start_x + vector_x * t)
+        offset_y = y - (self.start_y + vector_y * t)
+        distance_sq = offset_x * offset_x + offset_y * offset_y
+        reach = radius + self.radius
+        if distance_sq >= reach * reach:
+            return None
+        if distance_sq == 0:
+            if self.normal_x * direction_x + self.normal_y * direction_y > 0:
+                return -self.normal_x, -self.normal_y, reach
+            return self.normal_x, self.normal_y, reach
+        distance = math.sqrt(distance_sq)
+        inverse = 1 / distance
+        return offset_x * inverse, offset_y * inverse, reach - distance
+
+    #Sweeps a circle from start along motion and returns the fraction of the motion and the normal at
+    #the first touch, or None if it does not touch. Circles that already overlap are left to contact()
+    def time_of_impact(self, start, motion, radius):
+        impact = self.impact(start[0], start[1], motion[0], motion[1], radius)
+        if impact is None:
+            return None
+        return impact[0], pygame.Vector2(impact[1], impact[2])
+
+    #time_of_impact() on floats, as (fraction, normal x, normal y)
+    def impact(self, x, y, motion_x, motion_y, radius):
+        end_x = x + motion_x
+        end_y = y + motion_y
+        if motion_x < 0:
+            if x + radius <= self.left or end_x - radius >= self.right:
+                return None
+        elif end_x + radius <= self.left or x - radius >= self.right:
+            return None
+        if motion_y < 0:
+            if y + radius <= self.top or end_y - radius >= self.bottom:
+                return None
+        elif end_y + radius <= self.top or y - radius >= self.bottom:
+            return None
+        reach = radius + self.radius
+        normal_x = self.normal_x
+        normal_y = self.normal_y
+        start_x = self.start_x
+        start_y = self.start_y
+        distance = (x - start_x) * normal_x + (y - start_y) * normal_y
+        if distance < 0:
+            normal_x = -normal_x
+            normal_y = -normal_y
+            distance = -distance
+        approach = motion_x * normal_x + motion_y * normal_y
+        if distance >= reach and approach < 0:
+            t = (distance - reach) / -approach
+            if t > 1:
+                return None
+            u = ((x + motion_x * t - start_x) * self.vector_x + (y + motion_y * t - start_y) * self.vector_y) / self.length_sq
+            if 0 <= u <= 1:
+                return t, normal_x, normal_y
+        elif distance < reach:
+            u = ((x - start_x) * self.vector_x + (y - start_y) * self.vector_y) / self.length_sq
+            if 0 <= u <= 1:
+                return None
+        first = None
+        a = motion_x * motion_x + motion_y * motion_y
+        if a == 0:
+            return None
+        reach_sq = reach * reach
+        for point_x, point_y in ((start_x, start_y), (self.end_x, self.end_y)):
+            offset_x = x - point_x
+            offset_y = y - point_y
+            b = offset_x * motion_x + offset_y * motion_y
+            c = offset_x * offset_x + offset_y * offset_y - reach_sq
+            if c < 0:
+                return None
+            discriminant = b * b - a * c
+            if b >= 0 or discriminant < 0:
+                continue
+            t = (-b - math.sqrt(discriminant)) / a
+            if t <= 1 and (first is None or t < first[0]):
+                first = (t, (offset_x + motion_x * t) * (1 / reach), (offset_y + motion_y * t) * (1 / reach))
+        return first
+
+    #Takes a touch() result and returns the ball centre after it, as (x, y)
+    @abstractmethod
+    def resolve(self, ball, x, y, normal_x, normal_y, depth):
+        pass
+
+    def bounce(self, ball, normal) -> None:
+        pass
+
+
+class WallSegment(Segment):
+    points = 1000
+
+    def __init__(self, start, end, radius, preserved_energy) -> None:
+        super().__init__(start, end, radius)
+        self.preserved_energy = preserved_energy
+
+    #Pushes the ball out along the contact normal and reflects it if it is moving into the wall
+    def resolve(self, ball, x, y, normal_x, normal_y, depth):
+        self.bounce(ball, pygame.Vector2(normal_x, normal_y))
+        return x + normal_x * depth, y + normal_y * depth
+
+    def bounce(self, ball, normal) -> None:
+        if ball.direction.dot(normal) < 0:
+            ball.direction = ball.direction.reflect(normal) * self.preserved_energy
+
+
+class RailSegment(Segment):
+    #Rails guide the ball along their line by moving it sideways onto it
+    def resolve(self, ball, x, y, normal_x, normal_y, depth):
+        return self.start_x + (y - self.start_y) * self.vector_x / self.vector_y, y
+
+
+#Uniform grid over static objects, so only the objects in the cells around the ball are tested
+class SpatialGrid(object):
+    def __init__(self, cell_size) -> None:
+        self.cell_size = cell_size
+        self.items = []
+        self.cells = {}
+        self.found = {}
+
+    def insert(self, item, left, top, right, bottom) -> None:
+        index = len(self.items)
+        self.items.append(item)
+        self.found.clear()
+        for cell in self.cells_in(left, top, right, bottom):
+            self.cells.setdefault(cell, []).append(index)
+
+    def cells_in(self, left, top, right, bottom):
+        size = self.cell_size
+        for x in range(int(left // size), int(right // size) + 1):
+            for y in range(int(top // size), int(bottom // size) + 1):
+                yield (x, y)
+
+    #Returns the items in the cells touched by the given bounds, in the order they were inserted.
+    #The grid is static, so the result for each block of cells is kept. Do not modify the returned list
+    def query(self, left, top, right, bottom):
+        size = self.cell_size
+        key = (int(left // size), int(top // size), int(right // size), int(bottom // size))
+        items = self.found.get(key)
+        if items is None:
+            found = set()
+            for x in range(key[0], key[2] + 1):
+                for y in range(key[1], key[3] + 1):
+                    found.update(self.cells.get((x, y), ()))
+            items = [self.items[index] for index in sorted(found)]
+            self.found[key] = items
+        return items
+
+
+class FlipperSegment(Segment):
+    def __init__(self, start, end, radius, flipper) -> None:
+        super().__init__(start, end, radius)
+        self.flipper = flipper
+
+    def resolve(self, ball, x, y, normal_x, normal_y, depth):
+        self.bounce(ball, pygame.Vector2(normal_x, normal_y))
+        return x + normal_x * depth, y + normal_y * depth
+
+    def bounce(self, ball, normal) -> None:
+        self.flipper.bounce(ball, normal)
+
+
+#Pixel perfect collision between the ball and the walls and rails using their masks
+class MaskCollision(object):
+    def __init__(self, table) -> None:
+        self.table = table
+        self.ball = table.ball.sprite
+
+    def move_ball(self, deltatime) -> None:
+        self.ball.update(deltatime)
+
+    def collision(self, grid):
+        ball = self.ball
+        rect = ball.rect
+        for sprite in grid.query(rect.left, rect.top, rect.right, rect.bottom):
+            if pygame.sprite.collide_mask(sprite, ball):
+                yield sprite
+
+    def assign_collision(self) -> None:
+        profiler = self.table.profiler
+        hits = self.table.hits
+        for wall in self.collision(self.table.wall_grid):
+            wall.control_ball()
+            self.table.score.add_points(1000)
+            profiler.count()
+            if hits is not None:
+                hits.append(wall.index)
+        profiler.mark('walls')
+
+        for rail in self.collision(self.table.rail_grid):
+            rail.control_ball()
+            profiler.count()
+            if hits is not None:
+                hits.append(rail.index)
+        profiler.mark('rails')
+
+    def flipper_collision(self, flipper) -> None:
+        if pygame.sprite.collide_mask(flipper, self.ball):
+            flipper.control_ball()
+            self.table.profiler.count()
+
+
+#Closed form collision between the ball circle and the walls and rails as line segments
+class AnalyticCollision(object):
+    def __init__(self, table) -> None:
+        self.table = table
+        self.ball = table.ball.sprite
+        self.flippers = [table.leftflipper.sprite, table.rightflipper.sprite]
+        self.walls = table.wall_segment_grid
+        self.rails = table.rail_segment_grid
+        #Bounds of the flipper segments in all their poses, the sweep only tests them inside it
+        frames = [segment for flipper in self.flippers for image, mask, segment in flipper.frames]
+        self.flipper_bounds = (min(segment.left for segment in frames), min(segment.top for segment in frames),
+                               max(segment.right for segment in frames), max(segment.bottom for segment in frames))
+        self.max_impacts = 4
+        self.skin = 0.01
+
+    #Moves the ball to the first wall it touches on its way, bounces it and carries on with the rest of the motion
+    def move_ball(self, deltatime) -> None:
+        ball = self.ball
+        ball.sync_position()
+        ball.accelerate(deltatime)
+        pos = ball.pos
+        x = pos[0]
+        y = pos[1]
+        remaining = deltatime
+        radius = ball.radius
+        left_flipper, right_flipper = self.flippers
+        flipper_left, flipper_top, flipper_right, flipper_bottom = self.flipper_bounds
+        for _ in range(self.max_impacts):
+            direction = ball.direction
+            motion_x = direction[0] * remaining
+            motion_y = direction[1] * remaining
+            end_x = x + motion_x
+            end_y = y + motion_y
+            if motion_x < 0:
+                left, right = end_x - radius, x + radius
+            else:
+                left, right = x - radius, end_x + radius
+            if motion_y < 0:
+                top, bottom = end_y - radius, y + radius
+            else:
+                top, bottom = y - radius, end_y + radius
+            walls = self.walls.query(left, top, right, bottom)
+            if right > flipper_left and left < flipper_right and bottom > flipper_top and top < flipper_bottom:
+                walls = walls + [left_flipper.segment, right_flipper.segment]
+            first = None
+            for wall in walls:
+                impact = wall.impact(x, y, motion_x, motion_y, radius)
+                if impact and (first is None or impact[0] < first[0]):
+                    first = impact
+                    first_wall = wall
+            if first is None:
+                x = end_x
+                y = end_y
+                break
+            t, normal_x, normal_y = first
+            x += motion_x * t + normal_x * self.skin
+            y += motion_y * t + normal_y * self.skin
+            first_wall.bounce(ball, pygame.Vector2(normal_x, normal_y))
+            if first_wall.points:
+                self.table.score.add_points(first_wall.points)
+            self.table.profiler.count()
+            if self.table.hits is not None and first_wall.index is not None:
+                self.table.hits.append(first_wall.index)
+            remaining -= remaining * t
+        ball.move_to((x, y))
+
+    def assign_collision(self) -> None:
+        ball = self.ball
+        profiler = self.table.profiler
+        hits = self.table.hits
+        ball.sync_position()
+        pos = ball.pos
+        x = pos[0]
+        y = pos[1]
+        radius = ball.radius
+        left, top, right, bottom = x - radius, y - radius, x + radius, y + radius
+        moved = False
+        for wall in self.walls.query(left, top, right, bottom):
+            touch = wall.touch(x, y, radius, ball.direction[0], ball.direction[1])
+            if touch:
+                x, y = wall.resolve(ball, x, y, *touch)
+                moved = True
+                self.table.score.add_points(wall.points)
+                profiler.count()
+                if hits is not None:
+                    hits.append(wall.index)
+        profiler.mark('walls')
+
+        for rail in self.rails.query(left, top, right, bottom):
+            touch = rail.touch(x, y, radius, ball.direction[0], ball.direction[1])
+            if touch:
+                x, y = rail.resolve(ball, x, y, *touch)
+                moved = True
+                profiler.count()
+                if hits is not None:
+                    hits.append(rail.index)
+        if moved:
+            ball.move_to((x, y))
+        profiler.mark('rails')
+
+    #The flipper's segment is tested directly, its sprite rect around all poses is much larger than the segment
+    def flipper_collision(self, flipper) -> None:
+        ball = self.ball
+        ball.sync_position()
+        pos = ball.pos
+        direction = ball.direction
+        touch = flipper.segment.touch(pos[0], pos[1], ball.radius, direction[0], direction[1])
+        if touch:
+            ball.move_to(flipper.segment.resolve(ball, pos[0], pos[1], *touch))
+            self.table.profiler.count()
+
+
+#Extra balls of the multi-ball mode. Positions and velocities of all balls live in numpy arrays and are moved, bounced
+#off the walls, rails and flippers and against each other in one go. The player's ball keeps its sprite and joins the
+#ball to ball collisions. Balls move at most one radius per sub-step, so no sweep is needed
+class MultiBall(object):
+    restitution = 0.9
+    max_substeps = 16
+    neighbours = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+    def __init__(self, table, count, radius=None) -> None:
+        if numpy is None:
+            raise ImportError("the multi-ball mode needs numpy")
+        self.table = table
+        ball = table.ball.sprite
+        self.radius = ball.radius if radius is None else radius
+        self.gravity = ball.gravity
+        self.image = Assets.image(ball.image_name, (round(2 * self.radius), round(2 * self.radius)))
+        self.flippers = [table.leftflipper.sprite, table.rightflipper.sprite]
+        self.sprites = []
+        launcher = table.chargedlauncher.sprite
+        #Extra balls come to rest on the launcher instead of falling through it
+        floor = WallSegment(launcher.rect.topleft, launcher.rect.topright, 0, 0.5)
+        floor.points = 0
+        self.index_segments(table.layout.segments() + [floor])
+        self.spawn(count)
+
+    #Segment geometry as arrays, and for every grid cell the segments a ball centered in it can touch
+    def index_segments(self, segments) -> None:
+        self.starts = numpy.array([tuple(segment.start) for segment in segments], dtype=float)
+        self.vectors = numpy.array([tuple(segment.vector) for segment in segments], dtype=float)
+        self.normals = numpy.array([tuple(segment.normal) for segment in segments], dtype=float)
+        self.lengths_sq = numpy.array([segment.length_sq for segment in segments])
+        self.segment_radii = numpy.array([segment.radius for segment in segments])
+        self.rail = numpy.array([isinstance(segment, RailSegment) for segment in segments])
+        self.energy = numpy.array([getattr(segment, 'preserved_energy', 1.0) for segment in segments])
+        self.points = numpy.array([segment.points for segment in segments])
+        cell = Settings.grid_cell
+        self.columns = Settings.window['width'] // cell + 1
+        self.rows = Settings.window['height'] // cell + 1
+        cells = [[] for _ in range(self.columns * self.rows)]
+        for index, segment in enumerate(segments):
+            left = min(self.columns - 1, max(0, int((segment.left - self.radius) // cell)))
+            right = min(self.columns - 1, max(0, int((segment.right + self.radius) // cell)))
+            top = min(self.rows - 1, max(0, int((segment.top - self.radius) // cell)))
+            bottom = min(self.rows - 1, max(0, int((segment.bottom + self.radius) // cell)))
+            for row in range(top, bottom + 1):
+                for column in range(left, right + 1):
+                    cells[row * self.columns + column].append(index)
+        self.cell_counts = numpy.array([len(items) for items in cells], dtype=numpy.int64)
+        self.cell_starts = numpy.cumsum(self.cell_counts) - self.cell_counts
+        self.cell_items = numpy.array([index for items in cells for index in items], dtype=numpy.int64)
+
+    #Staggered rows from the top of the playfield. Rows that do not fit start over at the top, a third of a ball
+    #further, and push each other apart
+    def spawn(self, count) -> None:
+        table = self.table
+        spacing = 2 * self.radius + 2
+        left = table.l_guide + spacing
+        right = table.chargedlauncher.sprite.rect.left - 2 * spacing
+        columns = max(1, int((right - left) // spacing))
+        rows = max(1, int((table.b_guide - 300 - table.t_guide) // spacing))
+        index = numpy.arange(count)
+        row = index // columns
+        layer = row // rows
+        self.pos = numpy.empty((count, 2))
+        self.pos[:, 0] = left + index % columns * spacing + row % 2 * spacing / 2 + layer * spacing / 3
+        self.pos[:, 1] = table.t_guide + spacing + row % rows * spacing + layer * spacing / 3
+        self.vel = numpy.zeros((count, 2))
+        self.previous = self.pos.copy()
+
+    def __len__(self):
+        return len(self.pos)
+
+    #Pairs (owner, item) for every owner and each of the counts[owner] items from starts[owner] on
+    @staticmethod
+    def expand(owners, starts, counts):
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        return numpy.repeat(owners, counts), numpy.repeat(starts, counts) + offsets
+
+    #Adds each row of values to the row of target given by indices, which may repeat. Faster than numpy.add.at
+    @staticmethod
+    def scatter_add(target, indices, values) -> None:
+        target[:, 0] += numpy.bincount(indices, values[:, 0], len(target))
+        target[:, 1] += numpy.bincount(indices, values[:, 1], len(target))
+
+    #Offset from the closest point on each segment to each center and its squared length
+    @staticmethod
+    def closest(centers, starts, vectors, lengths_sq):
+        offsets = centers - starts
+        t = numpy.clip(numpy.einsum('ij,ij->i', offsets, vectors) / lengths_sq, 0, 1)
+        offsets -= vectors * t[:, None]
+        return offsets, numpy.einsum('ij,ij->i', offsets, offsets)
+
+    #Unit normals pointing from the segments to the centers. Centers right on a segment use its normal against the velocity
+    @staticmethod
+    def contact_normals(offsets, distances, normals, velocities):
+        inside = distances == 0
+        if inside.any():
+            normals = numpy.where((numpy.einsum('ij,ij->i', normals, velocities) > 0)[:, None], -normals, normals)
+            return numpy.where(inside[:, None], normals, offsets / numpy.where(inside, 1, distances)[:, None])
+        return offsets / distances[:, None]
+
+    def step(self, deltatime) -> None:
+        self.previous = self.pos.copy()
+        if not len(self.pos):
+            return
+        self.vel[:, 1] += self.gravity * deltatime
+        speed = math.sqrt(numpy.einsum('ij,ij->i', self.vel, self.vel).max())
+        substeps = min(MultiBall.max_substeps, max(1, math.ceil(speed * deltatime / self.radius)))
+        substep = deltatime / substeps
+        for _ in range(substeps):
+            self.pos += self.vel * substep
+            self.collide_segments()
+            self.collide_flippers()
+            self.collide_balls()
+        self.drain()
+
+    def collide_segments(self) -> None:
+        pos, vel = self.pos, self.vel
+        cell = Settings.grid_cell
+        columns = numpy.clip((pos[:, 0] // cell).astype(numpy.int64), 0, self.columns - 1)
+        rows = numpy.clip((pos[:, 1] // cell).astype(numpy.int64), 0, self.rows - 1)
+        cells = rows * self.columns + columns
+        balls, items = MultiBall.expand(numpy.arange(len(pos)), self.cell_starts[cells], self.cell_counts[cells])
+        segments = self.cell_items[items]
+        offsets, distances_sq = MultiBall.closest(pos[balls], self.starts[segments], self.vectors[segments], self.lengths_sq[segments])
+        reach = self.radius + self.segment_radii[segments]
+        touching = distances_sq < reach * reach
+        if not touching.any():
+            return
+        balls, segments, offsets, reach = balls[touching], segments[touching], offsets[touching], reach[touching]
+        distances = numpy.sqrt(distances_sq[touching])
+
+        rails = self.rail[segments]
+        walls = ~rails
+        if walls.any():
+            balls_w, segments_w = balls[walls], segments[walls]
+            normals = MultiBall.contact_normals(offsets[walls], distances[walls], self.normals[segments_w], vel[balls_w])
+            MultiBall.scatter_add(pos, balls_w, normals * (reach[walls] - distances[walls])[:, None])
+            #A ball touching several walls is reflected by the deepest one it moves into
+            approach = numpy.einsum('ij,ij->i', vel[balls_w], normals)
+            moving = approach < 0
+            if moving.any():
+                depth = (reach[walls] - distances[walls])[moving]
+                order = numpy.lexsort((depth, balls_w[moving]))
+                sorted_balls = balls_w[moving][order]
+                last = order[numpy.append(sorted_balls[1:] != sorted_balls[:-1], True)]
+                balls_b = balls_w[moving][last]
+                normals_b = normals[moving][last]
+                segments_b = segments_w[moving][last]
+                vel[balls_b] = (vel[balls_b] - 2 * approach[moving][last][:, None] * normals_b) * self.energy[segments_b][:, None]
+                self.table.score.add_points(int(self.points[segments_b].sum()))
+                self.table.profiler.count(len(balls_b))
+
+        if rails.any():
+            balls_r, segments_r = balls[rails], segments[rails]
+            starts, vectors = self.starts[segments_r], self.vectors[segments_r]
+            pos[balls_r, 0] = starts[:, 0] + (pos[balls_r, 1] - starts[:, 1]) * vectors[:, 0] / vectors[:, 1]
+
+    def collide_flippers(self) -> None:
+        pos, vel = self.pos, self.vel
+        radius = self.radius
+        for flipper in self.flippers:
+            rect = flipper.rect
+            near = numpy.flatnonzero((pos[:, 0] > rect.left - radius) & (pos[:, 0] < rect.right + radius)
+                                     & (pos[:, 1] > rect.top - radius) & (pos[:, 1] < rect.bottom + radius))
+            if not len(near):
+                continue
+            segment = flipper.segment
+            starts = numpy.array([tuple(segment.start)])
+            vectors = numpy.array([tuple(segment.vector)])
+            offsets, distances_sq = MultiBall.closest(pos[near], starts, vectors, segment.length_sq)
+            reach = radius + segment.radius
+            touching = distances_sq < reach * reach
+            if not touching.any():
+                continue
+            balls = near[touching]
+            distances = numpy.sqrt(distances_sq[touching])
+            normals = MultiBall.contact_normals(offsets[touching], distances, numpy.array([tuple(segment.normal)]), vel[balls])
+            pos[balls] += normals * (reach - distances)[:, None]
+            #Velocity of the flipper surface where the balls touch it, as in Flipper.surface_velocity
+            points = pos[balls] - normals * radius - tuple(flipper.pivot)
+            surface = numpy.stack((-points[:, 1], points[:, 0]), axis=1) * (math.radians(flipper.angular_velocity) * flipper.side)
+            approach = numpy.einsum('ij,ij->i', vel[balls] - surface, normals)
+            moving = approach < 0
+            vel[balls[moving]] -= normals[moving] * (approach[moving] * (1 + flipper.restitution))[:, None]
+            self.table.profiler.count(len(balls))
+
+    #Pairs of balls in the same or neighbouring cells of a uniform grid over the window. The balls are sorted by cell
+    #and every cell knows where its balls start. Each cell is only paired with half of its neighbours so every pair
+    #comes up once. A border of empty cells keeps the neighbours of the outer cells inside the grid
+    def ball_pairs(self, pos, cell):
+        columns = int(Settings.window['width'] // cell) + 3
+        rows = int(Settings.window['height'] // cell) + 3
+        column = numpy.clip(pos[:, 0] // cell, 0, columns - 3).astype(numpy.int64) + 1
+        row = numpy.clip(pos[:, 1] // cell, 0, rows - 3).astype(numpy.int64) + 1
+        cells = row * columns + column
+        order = numpy.argsort(cells, kind='stable')
+        counts = numpy.bincount(cells, minlength=columns * rows)
+        starts = numpy.cumsum(counts) - counts
+        owners = numpy.arange(len(pos))
+        firsts, seconds = [], []
+        for column_offset, row_offset in MultiBall.neighbours:
+            neighbour = cells + row_offset * columns + column_offset
+            first, slots = MultiBall.expand(owners, starts[neighbour], counts[neighbour])
+            second = order[slots]
+            if column_offset == 0 and row_offset == 0:
+                keep = first < second
+                first, second = first[keep], second[keep]
+            firsts.append(first)
+            seconds.append(second)
+        return numpy.concatenate(firsts), numpy.concatenate(seconds)
+
+    #Equal masses, so both balls move apart by half the overlap and share the impulse. All contacts are solved at
+    #once, so pushes and impulses are divided by the contact count of the busier ball to keep piles from blowing up.
+    #The grid is sized for the extra balls, the player's ball is tested against all of them
+    def collide_balls(self) -> None:
+        main = self.table.ball.sprite
+        main.sync_position()
+        pos = numpy.vstack((self.pos, (tuple(main.pos),)))
+        vel = numpy.vstack((self.vel, (tuple(main.direction),)))
+        radii = numpy.full(len(pos), self.radius)
+        radii[-1] = main.radius
+        last = len(pos) - 1
+        first, second = self.ball_pairs(self.pos, 2 * self.radius)
+        offsets = self.pos - pos[last]
+        reach = self.radius + main.radius
+        near = numpy.flatnonzero(numpy.einsum('ij,ij->i', offsets, offsets) < reach * reach)
+        if len(near):
+            first = numpy.concatenate((first, near))
+            second = numpy.concatenate((second, numpy.full(len(near), last)))
+        offsets = pos[second] - pos[first]
+        distances_sq = numpy.einsum('ij,ij->i', offsets, offsets)
+        reach = radii[first] + radii[second]
+        touching = (distances_sq < reach * reach) & (distances_sq > 0)
+        if not touching.any():
+            return
+        first, second, offsets, reach = first[touching], second[touching], offsets[touching], reach[touching]
+        distances = numpy.sqrt(distances_sq[touching])
+        normals = offsets / distances[:, None]
+        contacts = numpy.bincount(first, minlength=len(pos)) + numpy.bincount(second, minlength=len(pos))
+        share = 1 / numpy.maximum(contacts[first], contacts[second])
+        push = normals * ((reach - distances) / 2 * share)[:, None]
+        MultiBall.scatter_add(pos, first, -push)
+        MultiBall.scatter_add(pos, second, push)
+        approach = numpy.einsum('ij,ij->i', vel[second] - vel[first], normals)
+        impulse = numpy.where(approach < 0, -(1 + MultiBall.restitution) * approach / 2 * share, 0)[:, None] * normals
+        MultiBall.scatter_add(vel, first, -impulse)
+        MultiBall.scatter_add(vel, second, impulse)
+        self.pos = pos[:-1]
+        self.vel = vel[:-1]
+        if (first == last).any() or (second == last).any():
+            main.direction.update(vel[-1].tolist())
+            main.move_to(pos[-1].tolist())
+
+    #Balls below the table are gone for good, as are balls pushed through its sides by a pile
+    def drain(self) -> None:
+        x, y = self.pos[:, 0], self.pos[:, 1]
+        keep = (y - self.radius <= self.table.b_guide) & (y >= 0) & (x >= 0) & (x <= Settings.window['width'])
+        if not keep.all():
+            self.pos = self.pos[keep]
+            self.vel = self.vel[keep]
+            self.previous = self.previous[keep]
+
+    #Positions alpha of the way from before the last step to now, like Ball.interpolated_rect
+    def interpolated(self, alpha):
+        return self.previous + (self.pos - self.previous) * alpha
+
+    def draw(self, screen, alpha=1.0) -> None:
+        half_x, half_y = self.image.get_rect().center
+        screen.blits([(self.image, (round(x) - half_x, round(y) - half_y)) for x, y in self.interpolated(alpha).tolist()], False)
+
+    #One sprite per ball for the DirtyRenderer
+    def layers(self, alpha=1.0):
+        while len(self.sprites) < len(self.pos):
+            sprite = pygame.sprite.Sprite()
+            sprite.image = self.image
+            sprite.rect = self.image.get_rect()
+            self.sprites.append(sprite)
+        for sprite, (x, y) in zip(self.sprites, self.interpolated(alpha).tolist()):
+            sprite.rect.center = (round(x), round(y))
+        return self.sprites[:len(self.pos)]
+
+
+#Layout of a table, read from a json file in tables/. The walls and rails are compiled once into flat arrays
+#of sprite placements and collision segments, which are cached in tables/__pycache__ until the file changes
+class Layout(object):
+    version = 1
+    pieces = ['WallV', 'WallH', 'WallDTB', 'WallDBT', 'RailDTB', 'RailDBT']
+    #The only classes a layout file can name
+    classes = {piece_class.__name__: piece_class for piece_class in (WallV, WallH, WallDTB, WallDBT, RailDTB, RailDBT,
+                                                                     LeftFlipper, RightFlipper, ChargedLauncher)}
+    placement_size = 5
+    segment_size = 7
+
+    def __init__(self, data, images, placements, segment_data) -> None:
+        self.data = data
+        self.images = images
+        self.placements = placements
+        self.segment_data = segment_data
+
+    @staticmethod
+    def piece_class(name):
+        try:
+            return Layout.classes[name]
+        except KeyError:
+            raise ValueError("unknown piece type {!r} in the layout, expected one of {}".format(name, ", ".join(Layout.classes))) from None
+
+    @staticmethod
+    def cache_path(path):
+        return os.path.join(os.path.dirname(path), '__pycache__', os.path.basename(path) + '.layout')
+
+    @staticmethod
+    def load(path):
+        stat = os.stat(path)
+        source = (stat.st_mtime_ns, stat.st_size)
+        cache = Layout.cache_path(path)
+        try:
+            with open(cache, 'rb') as file:
+                compiled = pickle.load(file)
+            if compiled['version'] == Layout.version and compiled['source'] == source:
+                return Layout(compiled['data'], compiled['images'], compiled['placements'], compiled['segments'])
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+            pass
+        with open(path) as file:
+            layout = Layout.compile(json.load(file))
+        try:
+            os.makedirs(os.path.dirname(cache), exist_ok=True)
+            with open(cache, 'wb') as file:
+                pickle.dump({'version': Layout.version, 'source': source, 'data': layout.data, 'images': layout.images,
+                             'placements': layout.placements, 'segments': layout.segment_data}, file, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            pass
+        return layout
+
+    @staticmethod
+    def compile(data):
+        images = []
+        placements = array('d')
+        segments = array('d')
+        for piece in data['walls'] + data['rails']:
+            kind = piece['type']
+            piece_class = Layout.piece_class(kind)
+            x, y, width, height = piece['x'], piece['y'], piece['width'], piece['height']
+            images.append(piece.get('image', "wall.png"))
+            placements.extend((Layout.pieces.index(kind), x, y, width, height))
+            center_x, center_y = Layout.piece_rect(piece_class, x, y, width, height).center
+            half_x = piece_class.axis[0] * height / 2
+            half_y = piece_class.axis[1] * height / 2
+            segments.extend((center_x - half_x, center_y - half_y, center_x + half_x, center_y + half_y,
+                             width / 2, piece_class.rail, piece_class.preserved_energy))
+        data = {key: value for key, value in data.items() if key not in ('walls', 'rails')}
+        return Layout(data, images, placements, segments)
+
+    #The rect the sprite of a piece gets, without loading its image
+    @staticmethod
+    def piece_rect(piece_class, x, y, width, height):
+        rect = pygame.Rect((0, 0), Layout.rotated_size(int(width), int(height), piece_class.angle))
+        setattr(rect, piece_class.anchor, (x, y))
+        return rect
+
+    #Size of a surface after pygame.transform.rotate
+    @staticmethod
+    def rotated_size(width, height, angle):
+        if angle % 90 == 0:
+            return (height, width) if angle % 180 else (width, height)
+        sine = math.sin(math.radians(angle))
+        cosine = math.cos(math.radians(angle))
+        cx, cy, sx, sy = cosine * width, cosine * height, sine * width, sine * height
+        return (int(max(abs(cx + sy), abs(cx - sy), abs(-cx + sy), abs(-cx - sy))),
+                int(max(abs(sx + cy), abs(sx - cy), abs(-sx + cy), abs(-sx - cy))))
+
+    #Yields (class, x, y, width, height, image) for every wall and rail
+    def pieces_in_layout(self):
+        size = Layout.placement_size
+        for index, image in enumerate(self.images):
+            kind, x, y, width, height = self.placements[index * size:index * size + size]
+            yield Layout.piece_class(Layout.pieces[int(kind)]), x, y, width, height, image
+
+    def segments(self):
+        segments = []
+        size = Layout.segment_size
+        for index in range(len(self.segment_data) // size):
+            x1, y1, x2, y2, radius, rail, preserved_energy = self.segment_data[index * size:index * size + size]
+            if rail:
+                segment = RailSegment((x1, y1), (x2, y2), radius)
+            else:
+                segment = WallSegment((x1, y1), (x2, y2), radius, preserved_energy)
+            segment.index = index
+            segments.append(segment)
+        return segments
+
+
 class Table(object):
-    def __init__(self) -> None:
-        self.width = 500
-        self.height = 700
-        self.margin_t = 100
-        self.margin_lr = 150
+    def __init__(self, layout=None) -> None:
+        self.layout = Layout.load(Settings.tablepath(layout or Settings.layout))
+        self.width = self.layout.data['width']
+        self.height = self.layout.data['height']
+        self.margin_t = self.layout.data['margin_top']
+        self.margin_lr = self.layout.data['margin_side']
         self.t_guide = self.margin_t
         self.r_guide = self.width + self.margin_lr
         self.b_guide = self.height + self.margin_t
         self.l_guide = self.margin_lr
         self.cx_guide = self.margin_lr + self.width / 2
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        self.steps = 0
+        self.recorder = None
+        #Keys stamped with the time they arrived, waiting for the physics step they fall into
+        self.inputs = deque()
+        self.latency = None
+        self.events = NullEventLog()
+        #Set to a Rewind to keep the recent states, BACKSPACE then goes back in time
+        self.rewind = None
+        self.profiler = NullProfiler()
+        #Set to a list to collect the layout index of every wall and rail the ball touches
+        self.hits = None
+        self.multiball = None
         self.load_sound("fall.wav")
         self.objects()
 
     def restart(self) -> None:
+        self.events.emit("restart", points=self.score.points)
         Settings.gameover = False
         self.score.reset()
         self.chargedlauncher.sprite.reset()
+        self.start_multiball()
 
     def objects(self) -> None:
-        self.ball = pygame.sprite.GroupSingle(Ball(self.r_guide - 17, self.t_guide + 50, 25, 25, "ball.png"))
+        ball = self.layout.data['ball']
+        self.ball = pygame.sprite.GroupSingle(Ball(ball['x'], ball['y'], ball['width'], ball['height'], ball['image']))
+        #Where layers() shows the ball, between its last two physics positions
+        self.ball_view = pygame.sprite.Sprite()
         self.displays()
-        self.chargedlauncher = pygame.sprite.GroupSingle(ChargedLauncher(self.r_guide - 17, self.b_guide - 140, 25, 30, "chargedlauncher.png", 0, 2000, self.ball, self.chargedlauncher_display))
+        launcher = self.layout.data['launcher']
+        self.chargedlauncher = pygame.sprite.GroupSingle(ChargedLauncher(launcher['x'], launcher['y'], launcher['width'], launcher['height'], launcher['image'],
+                                                                         launcher['angle'], launcher['force'], self.ball, self.chargedlauncher_display))
         self.chargedlauncher.sprite.place_ball()
         self.walls = pygame.sprite.Group()
         self.rails = pygame.sprite.Group()
-        self.launchlane()
-        self.exitlanes()
-        self.borders()
+        #Headless the analytic engine only needs the compiled segments, so no sprite is built per piece
+        if Settings.collision == "mask" or not Settings.headless:
+            self.pieces()
         self.flippers()
+        self.build_grid()
+        self.start_multiball()
 
         #Uncomment the next line and line 626 for testing physics
         #self.debuglauncher = pygame.sprite.GroupSingle(DebugLauncher(440, 120, 25, 25, "debuglauncher.png", 0, 600, self.ball))
 
-    def displays(self) -> None:
-        self.chargedlauncher_display = Display(self.l_guide + 100, self.t_guide * 2 + 50, "Error")
-        self.score = Score(self.cx_guide, self.t_guide * 2)
+    def start_multiball(self) -> None:
+        if Settings.balls > 1:
+            self.multiball = MultiBall(self, Settings.balls - 1)
 
-    def load_sound(self, sound_name) -> None:
-        self.sound = pygame.mixer.Sound((Settings.soundpath(sound_name)))
+    #Sends score changes, launches, drains and game overs to events, an EventLog or a NullEventLog
+    def use_events(self, events) -> None:
+        self.events = events
+        self.score.events = events
+        self.chargedlauncher.sprite.events = events
 
-    def launchlane(self) -> None:
-        self.walls.add(WallV(self.r_guide - 40, self.t_guide + 40, 5, self.height - 140, "wall.png", self.ball))
-        self.walls.add(WallDTB(self.r_guide - 13, self.t_guide, 5, 20, "wall.png", self.ball))
+    def displays(self) -> None:
+        displays = self.layout.data['displays']
+        self.chargedlauncher_display = Display(displays['launcher']['x'], displays['launcher']['y'], "Error")
+        self.score = Score(displays['score']['x'], displays['score']['y'])
 
-    def exitlanes(self) -> None:
-        self.walls.add(WallDTB(self.l_guide + 40, self.b_guide - 198, 5, 70, "wall.png", self.ball))
-        self.walls.add(WallDBT(self.r_guide - 76, self.b_guide - 197, 5, 70, "wall.png", self.ball))
+    def load_sound(self, sound_name) -> None:
+        self.sound = SoundBank.cue(sound_name)
 
-    def borders(self) -> None:
-        self.walls.add(WallH(self.l_guide, self.t_guide, 5, self.width, "wall.png", self.ball))
-        self.walls.add(WallV(self.l_guide, self.t_guide, 5, self.height, "wall.png", self.ball))
-        self.walls.add(WallV(self.r_guide, self.t_guide, 5, self.height, "wall.png", self.ball))
-        self.walls.add(WallDTB(self.l_guide, self.b_guide - 179, 5, 100, "wall.png", self.ball))
-        self.walls.add(WallDBT(self.r_guide - 36, self.b_guide - 177, 5, 100, "wall.png", self.ball))
-        self.rails.add(RailDTB(self.l_guide + 34, self.b_guide - 172, 1, self.width / 2, "wall.png", self.ball))
-        self.rails.add(RailDBT(self.r_guide - 70, self.b_guide - 172, 1, self.width / 2, "wall.png", self.ball))
+    def pieces(self) -> None:
+        for index, (piece_class, x, y, width, height, image) in enumerate(self.layout.pieces_in_layout()):
+            piece = piece_class(x, y, width, height, image, self.ball)
+            piece.index = index
+            if piece_class.rail:
+                self.rails.add(piece)
+            else:
+                self.walls.add(piece)
 
     def flippers(self) -> None:
-        self.leftflipper = pygame.sprite.GroupSingle(LeftFlipper(self.l_guide + 90, self.b_guide - 148, 150, 150, "flipper.png", self.ball))
-        self.rightflipper = pygame.sprite.GroupSingle(RightFlipper(self.r_guide - 276, self.b_guide - 148, 150, 150, "flipper.png", self.ball))
-
-    #Collision between ball and another group
-    def collision(self, collidegroup):
-        return pygame.sprite.groupcollide(collidegroup, self.ball, False, False, pygame.sprite.collide_mask)
+        flippers = {}
+        for flipper in self.layout.data['flippers']:
+            flippers[flipper['type']] = pygame.sprite.GroupSingle(Layout.piece_class(flipper['type'])(flipper['x'], flipper['y'], flipper['width'], flipper['height'], flipper['image'], self.ball))
+        self.leftflipper = flippers['LeftFlipper']
+        self.rightflipper = flippers['RightFlipper']
+
+    #Indexes the walls and rails for both collision backends, the sprites for the masks and the layout's segments for
+    #the analytic one, and sets the backend up on them. Call it again whenever their geometry changes
+    def build_grid(self) -> None:
+        self.wall_grid = SpatialGrid(Settings.grid_cell)
+        for wall in self.walls:
+            self.wall_grid.insert(wall, wall.rect.left, wall.rect.top, wall.rect.right, wall.rect.bottom)
+        self.rail_grid = SpatialGrid(Settings.grid_cell)
+        for rail in self.rails:
+            self.rail_grid.insert(rail, rail.rect.left, rail.rect.top, rail.rect.right, rail.rect.bottom)
+        self.wall_segment_grid = SpatialGrid(Settings.grid_cell)
+        self.rail_segment_grid = SpatialGrid(Settings.grid_cell)
+        for segment in self.layout.segments():
+            grid = self.rail_segment_grid if isinstance(segment, RailSegment) else self.wall_segment_grid
+            grid.insert(segment, segment.left, segment.top, segment.right, segment.bottom)
+        self.collision_backend()
+
+    def collision_backend(self) -> None:
+        if Settings.collision == "analytic":
+            self.collision_engine = AnalyticCollision(self)
+        else:
+            self.collision_engine = MaskCollision(self)
 
     def assign_collision(self) -> None:
-        if self.collision(self.chargedlauncher):
-            self.chargedlauncher.sprite.control_ball()
-            self.chargedlauncher.sprite.controlling = True
+        launcher = self.chargedlauncher.sprite
+        ball = self.ball.sprite
+        profiler = self.profiler
+        if launcher.rect.colliderect(ball.rect) and pygame.sprite.collide_mask(launcher, ball):
+            launcher.control_ball()
+            launcher.controlling = True
+            profiler.count()
         else:
-            self.chargedlauncher.sprite.controlling = False
+            launcher.controlling = False
+        profiler.mark('launcher_collision')
 
-        for wall in self.collision(self.walls):
-            wall.control_ball()
-            self.score.add_points(1000)
-
-        for rail in self.collision(self.rails):
-            rail.control_ball()
+        self.collision_engine.assign_collision()
+        for flipper in (self.leftflipper.sprite, self.rightflipper.sprite):
+            if flipper.rect.colliderect(ball.rect):
+                self.collision_engine.flipper_collision(flipper)
+        profiler.mark('flipper_collision')
 
     def out_of_table(self):
         if self.ball.sprite.rect.top > self.b_guide:
+            launcher = self.chargedlauncher.sprite
             self.sound.play()
             self.score.add_points(10000)
-            self.chargedlauncher.sprite.place_ball()
+            self.events.emit("drain", ball=launcher.ball_number, step=self.steps)
+            launcher.place_ball()
+            if Settings.gameover:
+                self.events.emit("gameover", points=self.score.points, step=self.steps)
 
     def watch_for_events(self, event) -> None:
+        if self.recorder and event.type in (KEYDOWN, KEYUP):
+            self.recorder.record(self.steps, event)
         if event.type == KEYDOWN:
             if event.key == K_a:
-                if pygame.sprite.groupcollide(self.leftflipper, self.ball, False, False, pygame.sprite.collide_mask):
-                    self.leftflipper.sprite.control_ball()
                 self.leftflipper.sprite.move()
             elif event.key == K_d:
-                if pygame.sprite.groupcollide(self.rightflipper, self.ball, False, False, pygame.sprite.collide_mask):
-                    self.rightflipper.sprite.control_ball()
                 self.rightflipper.sprite.move()
             elif event.key == K_SPACE:
                 self.chargedlauncher.sprite.charge()
             elif event.key == K_r:
                 self.restart()
+            elif event.key == K_BACKSPACE and self.rewind:
+                self.rewind.rewind(Rewind.key_seconds)
                 
             #Controls the DebugLauncher
             elif event.key == K_i:
@@ -616,77 +2294,1098 @@ class Table(object):
             elif event.key == K_SPACE:
                 self.chargedlauncher.sprite.launch_ball()
 
-    def update(self) -> None:
-        self.ball.update()
-        self.chargedlauncher.update()
-        self.assign_collision()
-        self.out_of_table()
+    #Queues a key pressed or released at timestamp, in seconds on Settings.clock, for update() to apply
+    def queue_input(self, event, timestamp) -> None:
+        self.inputs.append((timestamp, event))
+
+    #Applies the queued keys that arrived before until
+    def apply_inputs(self, until) -> None:
+        inputs = self.inputs
+        while inputs and inputs[0][0] < until:
+            timestamp, event = inputs.popleft()
+            self.watch_for_events(event)
+            if self.latency:
+                self.latency.applied(timestamp, event.key)
+
+    #Advances the physics in fixed timesteps, however long the frame took. alpha is how far the time left over
+    #reaches into the next step, the ball is drawn that far between its last two positions.
+    #The steps stand for the time up to now, so each queued key is applied right before the step it arrived in.
+    #Without now every queued key is applied before the first step
+    def update(self, now=None) -> None:
+        if Settings.gameover:
+            self.apply_inputs(math.inf)
+            return
+        self.accumulator = min(self.accumulator + Settings.deltatime, Settings.max_lag * Settings.clock.speed)
+        end = math.inf if now is None else now - self.accumulator
+        while self.accumulator >= Settings.timestep and not Settings.gameover:
+            end += Settings.timestep
+            self.apply_inputs(end)
+            self.step(Settings.timestep)
+            self.accumulator -= Settings.timestep
+        if Settings.gameover:
+            self.apply_inputs(math.inf)
+        self.alpha = self.accumulator / Settings.timestep
+
+    def step(self, deltatime) -> None:
+        self.steps += 1
+        substep = deltatime / Settings.substeps
+        leftflipper = self.leftflipper.sprite
+        rightflipper = self.rightflipper.sprite
+        launcher = self.chargedlauncher.sprite
+        profiler = self.profiler
+        self.ball.sprite.remember()
+        for _ in range(Settings.substeps):
+            leftflipper.update(substep)
+            rightflipper.update(substep)
+            profiler.mark('flippers')
+            self.collision_engine.move_ball(substep)
+            profiler.mark('ball')
+            launcher.update(substep)
+            profiler.mark('launcher')
+            self.assign_collision()
+            self.out_of_table()
+            profiler.mark('out_of_table')
+            if self.multiball:
+                self.multiball.step(substep)
+                profiler.mark('multiball')
+        if self.rewind:
+            self.rewind.record()
+
+    #Everything that changes while the table runs, as a TableState
+    def snapshot(self):
+        ball = self.ball.sprite
+        left = self.leftflipper.sprite
+        right = self.rightflipper.sprite
+        launcher = self.chargedlauncher.sprite
+        ball.sync_position()
+        state = TableState(array('d', (ball.pos[0], ball.pos[1], ball.previous[0], ball.previous[1], ball.direction[0],
+                                        ball.direction[1], left.angle, left.target, left.angular_velocity, right.angle,
+                                        right.target, right.angular_velocity, launcher.force, launcher.charging,
+                                        launcher.controlling, launcher.ball_number, self.score.points, Settings.gameover,
+                                        self.accumulator, self.alpha)), launcher.display.text)
+        if self.multiball:
+            state.multiball = (self.multiball.pos.copy(), self.multiball.vel.copy(), self.multiball.previous.copy())
+        return state
+
+    #Also takes the state of another table of the same layout, to branch off from it. steps is not restored,
+    #it keeps counting the steps run so the recorder stays in order
+    def restore(self, state) -> None:
+        (ball_x, ball_y, previous_x, previous_y, direction_x, direction_y, left_angle, left_target, left_velocity,
+         right_angle, right_target, right_velocity, force, charging, controlling, ball_number, points, gameover,
+         accumulator, alpha) = state.values
+        ball = self.ball.sprite
+        ball.move_to((ball_x, ball_y))
+        ball.previous.update(previous_x, previous_y)
+        ball.direction.update(direction_x, direction_y)
+        for flipper, angle, target, velocity in ((self.leftflipper.sprite, left_angle, left_target, left_velocity),
+                                                 (self.rightflipper.sprite, right_angle, right_target, right_velocity)):
+            flipper.angle = angle
+            flipper.target = target
+            flipper.angular_velocity = velocity
+            flipper.show_frame()
+        launcher = self.chargedlauncher.sprite
+        launcher.force = force
+        launcher.charging = bool(charging)
+        launcher.controlling = bool(controlling)
+        launcher.ball_number = int(ball_number)
+        launcher.display.update(state.launcher_text)
+        launcher.display_small.update(launcher.ball_number)
+        self.score.points = int(points)
+        self.score.scoredisplay.update(self.score.points)
+        Settings.gameover = bool(gameover)
+        self.accumulator = accumulator
+        self.alpha = alpha
+        if self.multiball and state.multiball:
+            pos, vel, previous = state.multiball
+            self.multiball.pos = pos.copy()
+            self.multiball.vel = vel.copy()
+            self.multiball.previous = previous.copy()
 
     def draw(self, screen) -> None:
+        profiler = self.profiler
         #self.debuglauncher.draw(screen)
         self.chargedlauncher.draw(screen)
+        profiler.mark('draw_launcher')
         self.chargedlauncher.sprite.display.draw(screen)
         self.chargedlauncher.sprite.display_small.draw(screen)
+        profiler.mark('draw_displays')
         self.walls.draw(screen)
+        profiler.mark('draw_walls')
         self.leftflipper.draw(screen)
         self.rightflipper.draw(screen)
+        profiler.mark('draw_flippers')
         self.rails.draw(screen)
+        profiler.mark('draw_rails')
         self.score.draw(screen)
-        self.ball.draw(screen)
+        profiler.mark('draw_score')
+        ball = self.ball.sprite
+        screen.blit(ball.image, ball.interpolated_rect(self.alpha))
+        profiler.mark('draw_ball')
+        if self.multiball:
+            self.multiball.draw(screen, self.alpha)
+            profiler.mark('draw_multiball')
+
+    #Same order as draw(). Groups never move and are baked into the background by the DirtyRenderer
+    def layers(self):
+        launcher = self.chargedlauncher.sprite
+        ball = self.ball.sprite
+        self.ball_view.image = ball.image
+        self.ball_view.rect = ball.interpolated_rect(self.alpha)
+        layers = [launcher, launcher.display, launcher.display_small, self.walls, self.leftflipper.sprite,
+                  self.rightflipper.sprite, self.rails, self.score.scoredisplay, self.ball_view]
+        if self.multiball:
+            layers += self.multiball.layers(self.alpha)
+        return layers
+
+    def draw_static(self, screen) -> None:
+        self.walls.draw(screen)
+        self.rails.draw(screen)
 
 
 class Background(object):
     def __init__(self) -> None:
         super().__init__()
-        self.image = pygame.image.load(os.path.join(Settings.imagepath("table.png")))
-        self.image = pygame.transform.scale(self.image, (Settings.dim())).convert()
+        self.image = Assets.background()
     
     def draw(self, screen) -> None:
         screen.blit(self.image, (0, 0))
 
 
+#Records every key event that reaches Table.watch_for_events together with the physics step it arrived before.
+#The physics settings are stored in the header so the log can be replayed headless with the same results
+class InputRecorder(object):
+    header = struct.Struct('<4sBdBBH')
+    entry = struct.Struct('<IBI')
+    magic = b'P45I'
+    version = 2
+    types = {KEYDOWN: 0, KEYUP: 1}
+    end = 2
+    collisions = ["mask", "analytic"]
+
+    def __init__(self) -> None:
+        self.data = bytearray(InputRecorder.header.pack(InputRecorder.magic, InputRecorder.version, Settings.timestep,
+                                                        Settings.substeps, InputRecorder.collisions.index(Settings.collision), Settings.balls))
+
+    def record(self, step, event) -> None:
+        self.data += InputRecorder.entry.pack(step, InputRecorder.types[event.type], event.key)
+
+    def finish(self, step) -> None:
+        self.data += InputRecorder.entry.pack(step, InputRecorder.end, 0)
+
+    def save(self, path) -> None:
+        with open(path, 'wb') as file:
+            file.write(self.data)
+
+    #Returns the settings from the header and the list of (step, event type, key)
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as file:
+            data = file.read()
+        magic, version, timestep, substeps, collision, balls = InputRecorder.header.unpack_from(data)
+        if magic != InputRecorder.magic or version != InputRecorder.version:
+            raise ValueError("{} is not an input log of this version".format(path))
+        settings = {'timestep': timestep, 'substeps': substeps, 'collision': InputRecorder.collisions[collision], 'balls': balls}
+        types = {value: key for key, value in InputRecorder.types.items()}
+        types[InputRecorder.end] = None
+        entries = [(step, types[kind], key) for step, kind, key in InputRecorder.entry.iter_unpack(data[InputRecorder.header.size:])]
+        return settings, entries
+
+
+#State of a table from Table.snapshot(). The numbers sit in one array of doubles in the order of fields,
+#the extra balls of a MultiBall in copies of its arrays
+class TableState(object):
+    __slots__ = ('values', 'launcher_text', 'multiball')
+    fields = ('ball_x', 'ball_y', 'previous_x', 'previous_y', 'direction_x', 'direction_y', 'left_angle', 'left_target',
+              'left_velocity', 'right_angle', 'right_target', 'right_velocity', 'force', 'charging', 'controlling',
+              'ball_number', 'points', 'gameover', 'accumulator', 'alpha')
+    index = {field: index for index, field in enumerate(fields)}
+
+    def __init__(self, values, launcher_text, multiball=None) -> None:
+        self.values = values
+        self.launcher_text = launcher_text
+        self.multiball = multiball
+
+    def __getitem__(self, field):
+        return self.values[TableState.index[field]]
+
+
+#Ring buffer of the table states of the last seconds, one every few physics steps. rewind() restores one of them
+#and forgets the newer ones, so the game goes on from there. state() hands out older states to branch off from
+class Rewind(object):
+    key_seconds = 1.0
+
+    def __init__(self, table, seconds=10.0, every=4) -> None:
+        self.table = table
+        self.every = every
+        self.capacity = max(1, int(seconds / (Settings.timestep * every)))
+        self.states = [None] * self.capacity
+        self.count = 0
+
+    def record(self) -> None:
+        if self.table.steps % self.every == 0:
+            self.states[self.count % self.capacity] = self.table.snapshot()
+            self.count += 1
+
+    def available(self):
+        return min(self.count, self.capacity)
+
+    #State from back states ago, 0 is the newest
+    def state(self, back):
+        if not 0 <= back < self.available():
+            return None
+        return self.states[(self.count - 1 - back) % self.capacity]
+
+    #Goes back about seconds, or as far as the buffer reaches
+    def rewind(self, seconds):
+        if not self.count:
+            return None
+        back = min(round(seconds / (Settings.timestep * self.every)), self.available() - 1)
+        state = self.state(back)
+        self.count -= back
+        self.table.restore(state)
+        return state
+
+
+#Draws the walls and rails onto the background once and afterwards only redraws the areas of the sprites and texts that changed
+class DirtyRenderer(object):
+    def __init__(self, screen, background, table) -> None:
+        self.screen = screen
+        self.table = table
+        self.static = background.image.copy()
+        self.table.draw_static(self.static)
+        self.previous = None
+        self.profiler = NullProfiler()
+
+    #The image and rect of every moving layer, None for the groups that never move
+    @staticmethod
+    def snapshot(layers):
+        areas = []
+        for layer in layers:
+            if isinstance(layer, pygame.sprite.AbstractGroup):
+                areas.append(None)
+            else:
+                areas.append((layer.image, layer.image.get_rect(topleft=layer.rect.topleft)))
+        return areas
+
+    #overlay are extra layers drawn above the table. Set previous to None after changing them to redraw everything
+    def draw(self, overlay=()) -> None:
+        layers = self.table.layers() + list(overlay)
+        self.present(layers, DirtyRenderer.snapshot(layers))
+
+    #Draws a snapshot of the layers, which may have been taken while another thread held the table
+    def present(self, layers, current) -> None:
+        profiler = self.profiler
+        if self.previous is None:
+            self.previous = current
+            self.screen.blit(self.static, (0, 0))
+            for area in current:
+                if area:
+                    self.screen.blit(*area)
+            profiler.mark('draw_dirty')
+            pygame.display.flip()
+            profiler.mark('flip')
+            return
+
+        dirty = []
+        for now, before in zip(current, self.previous):
+            if now and (now[0] is not before[0] or now[1] != before[1]):
+                dirty.append(before[1])
+                dirty.append(now[1])
+        #Layers that appeared or went away, like drained multi-balls
+        for area in current[len(self.previous):] + self.previous[len(current):]:
+            if area:
+                dirty.append(area[1])
+        self.previous = current
+        if not dirty:
+            profiler.mark('draw_dirty')
+            return
+
+        for area in dirty:
+            self.screen.set_clip(area)
+            self.screen.blit(self.static, area, area)
+            covered = False
+            for layer, now in zip(layers, current):
+                if now is None:
+                    #Static layers only have to be drawn again if something below them was
+                    if covered:
+                        layer.draw(self.screen)
+                elif now[1].colliderect(area):
+                    self.screen.blit(*now)
+                    covered = True
+        self.screen.set_clip(None)
+        profiler.mark('draw_dirty')
+        pygame.display.update(dirty)
+        profiler.mark('flip')
+
+
+#Predicts the path of a ball launched with a given force on a private headless table, so nothing happens to the table
+#in play. The game runs it in a worker process, tuning scripts can call Trajectory.predict(force) directly.
+#Each call starts from the same state, so the same force always gives the same path
+class Trajectory(object):
+    simulation = None
+    #How long a path is followed and every how many physics steps a point is taken
+    seconds = 1.0
+    every = 4
+    #The settings of the table that a Simulation does not keep. The predictions run on their own copy of them and
+    #hand the caller's back, so a game in the same process goes on as it was
+    fields = ('collision', 'substeps', 'layout', 'balls')
+    settings = None
+
+    @staticmethod
+    def swap(settings):
+        previous = {field: getattr(Settings, field) for field in Trajectory.fields}
+        for field, value in settings.items():
+            setattr(Settings, field, value)
+        return previous
+
+    @staticmethod
+    def setup(collision=None, timestep=None, substeps=None, layout=None) -> None:
+        previous = Trajectory.swap({'collision': collision or Settings.collision, 'substeps': substeps or Settings.substeps,
+                                    'layout': layout or Settings.layout, 'balls': 1})
+        try:
+            Trajectory.simulation = Simulation(timestep)
+            Trajectory.start = Trajectory.simulation.table.snapshot()
+        finally:
+            Trajectory.settings = Trajectory.swap(previous)
+
+    #Points (x, y) of the ball centre from the launch until it falls back into the launcher, drains or the time is up
+    @staticmethod
+    def predict(force):
+        if Trajectory.simulation is None:
+            Trajectory.setup()
+        previous = Trajectory.swap(Trajectory.settings)
+        Trajectory.simulation.enter()
+        try:
+            return Trajectory.follow(force)
+        finally:
+            Trajectory.simulation.leave()
+            Trajectory.settings = Trajectory.swap(previous)
+
+    @staticmethod
+    def follow(force):
+        simulation = Trajectory.simulation
+        table = simulation.table
+        table.restore(Trajectory.start)
+        ball = table.ball.sprite
+        launcher = table.chargedlauncher.sprite
+        ball.direction.update(0, 0)
+        launcher.control_ball()
+        launcher.controlling = True
+        launcher.force = force
+        launcher.launch_ball()
+        ball_number = launcher.ball_number
+        points = []
+        for step in range(int(Trajectory.seconds / Settings.timestep)):
+            if not simulation.advance() or launcher.controlling or launcher.ball_number != ball_number:
+                break
+            if step % Trajectory.every == 0:
+                ball.sync_position()
+                points.append((round(ball.pos[0], 1), round(ball.pos[1], 1)))
+        return points
+
+
+#Draws the predicted path of the ball while the launcher charges. The paths of all force buckets are predicted at
+#the start in a worker process and kept, the sprite shows the one of the current force once it has arrived
+class LaunchPreview(object):
+    bucket = 50
+    max_force = 3000
+
+    def __init__(self, launcher) -> None:
+        self.launcher = launcher
+        self.sprite = pygame.sprite.Sprite()
+        self.hide()
+        self.images = {}
+        self.shown = None
+        #A fresh interpreter, a forked one would share the window and mixer of the game
+        self.pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"), initializer=Trajectory.setup,
+                                        initargs=(Settings.collision, Settings.timestep, Settings.substeps, Settings.layout))
+        self.pending = {bucket: self.pool.submit(Trajectory.predict, bucket * LaunchPreview.bucket)
+                        for bucket in range(LaunchPreview.max_force // LaunchPreview.bucket + 1)}
+
+    def hide(self) -> None:
+        self.sprite.image = pygame.Surface((0, 0))
+        self.sprite.rect = self.sprite.image.get_rect()
+
+    #Dots along the path on a transparent surface just big enough for them
+    @staticmethod
+    def render(points):
+        xs = [x for x, y in points]
+        ys = [y for x, y in points]
+        left, top = min(xs) - 3, min(ys) - 3
+        image = pygame.Surface((max(xs) - left + 4, max(ys) - top + 4), pygame.SRCALPHA)
+        for x, y in points[1::2]:
+            pygame.draw.circle(image, (255, 255, 255, 160), (x - left, y - top), 2)
+        return Settings.convert_alpha(image), (left, top)
+
+    def update(self) -> None:
+        for bucket, future in list(self.pending.items()):
+            if future.done():
+                del self.pending[bucket]
+                points = future.result()
+                self.images[bucket] = LaunchPreview.render(points) if points else None
+        bucket = round(self.launcher.force / LaunchPreview.bucket) if self.launcher.charging and self.launcher.controlling else None
+        if bucket == self.shown:
+            return
+        self.shown = bucket
+        image = self.images.get(bucket)
+        if image:
+            self.sprite.image = image[0]
+            self.sprite.rect = image[0].get_rect(topleft=image[1])
+        else:
+            self.hide()
+            #Try again next frame, the path may still be on its way
+            self.shown = None
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+#Sends the moving state of the table to spectators as small datagrams over a local UDP or Unix socket. The game only
+#hands the newest state to publish(), a background thread encodes and sends it. A spectator subscribes by sending any
+#datagram and is dropped after timeout seconds without one. Every keyframe_every frames, and when someone subscribes,
+#a keyframe carries all fields, the frames between only the fields that differ from the keyframe. A lost datagram
+#therefore never corrupts more than itself, and a spectator that missed a keyframe waits for the next one
+class Broadcaster(object):
+    magic = b'P5'
+    header = struct.Struct('<2sIIH')
+    fields = ('ball_x', 'ball_y', 'ball_vx', 'ball_vy', 'left_angle', 'right_angle', 'force', 'points', 'ball_number', 'gameover')
+    formats = 'fffffffIBB'
+    structs = {}
+    keyframe_every = 60
+    timeout = 3.0
+
+    def __init__(self, address) -> None:
+        self.address = address
+        family, bind = Broadcaster.parse(address)
+        if family == socket.AF_UNIX and os.path.exists(bind):
+            os.remove(bind)
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.bind(bind)
+        self.socket.setblocking(False)
+        self.family = family
+        self.bind = bind
+        self.subscribers = {}
+        self.latest = None
+        self.ready = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self.send, name="broadcast", daemon=True)
+        self.thread.start()
+
+    #"udp:HOST:PORT" or "unix:PATH"
+    @staticmethod
+    def parse(address):
+        kind, _, rest = address.partition(":")
+        if kind == "udp":
+            host, _, port = rest.rpartition(":")
+            return socket.AF_INET, (host or "127.0.0.1", int(port))
+        if kind == "unix":
+            return socket.AF_UNIX, rest
+        raise ValueError("{} is neither udp:HOST:PORT nor unix:PATH".format(address))
+
+    @staticmethod
+    def state(table):
+        ball = table.ball.sprite
+        launcher = table.chargedlauncher.sprite
+        ball.sync_position()
+        return (ball.pos[0], ball.pos[1], ball.direction[0], ball.direction[1], table.leftflipper.sprite.angle,
+                table.rightflipper.sprite.angle, launcher.force, table.score.points, launcher.ball_number, Settings.gameover)
+
+    #Called by the game, costs a tuple and setting an event
+    def publish(self, table) -> None:
+        self.latest = Broadcaster.state(table)
+        self.ready.set()
+
+    @staticmethod
+    def struct(mask):
+        packer = Broadcaster.structs.get(mask)
+        if packer is None:
+            packer = struct.Struct('<' + "".join(code for index, code in enumerate(Broadcaster.formats) if mask & 1 << index))
+            Broadcaster.structs[mask] = packer
+        return packer
+
+    @staticmethod
+    def encode(sequence, key_sequence, values, keyframe):
+        if keyframe is None:
+            mask = (1 << len(Broadcaster.fields)) - 1
+        else:
+            mask = 0
+            for index, (value, key) in enumerate(zip(values, keyframe)):
+                if value != key:
+                    mask |= 1 << index
+        changed = [value for index, value in enumerate(values) if mask & 1 << index]
+        return Broadcaster.header.pack(Broadcaster.magic, sequence, key_sequence, mask) + Broadcaster.struct(mask).pack(*changed)
+
+    #Returns (sequence, key_sequence, {field: value}) of a datagram, or None for anything else
+    @staticmethod
+    def decode(data):
+        if len(data) < Broadcaster.header.size:
+            return None
+        magic, sequence, key_sequence, mask = Broadcaster.header.unpack_from(data)
+        packer = Broadcaster.struct(mask)
+        if magic != Broadcaster.magic or len(data) != Broadcaster.header.size + packer.size:
+            return None
+        names = [name for index, name in enumerate(Broadcaster.fields) if mask & 1 << index]
+        return sequence, key_sequence, dict(zip(names, packer.unpack_from(data, Broadcaster.header.size)))
+
+    #Takes note of the spectators that said hello, returns whether a new one is among them
+    def listen(self) -> bool:
+        joined = False
+        now = time.monotonic()
+        while True:
+            try:
+                data, address = self.socket.recvfrom(64)
+            except (BlockingIOError, InterruptedError):
+                break
+            joined = joined or address not in self.subscribers
+            self.subscribers[address] = now
+        for address, seen in list(self.subscribers.items()):
+            if now - seen > Broadcaster.timeout:
+                del self.subscribers[address]
+        return joined
+
+    def send(self) -> None:
+        sequence = 0
+        key_sequence = 0
+        keyframe = None
+        while self.running:
+            joined = self.listen()
+            if not self.ready.wait(0.1):
+                continue
+            self.ready.clear()
+            values = self.latest
+            sequence += 1
+            #Floats go out as 32 bits, compared as sent they only differ when the spectator would see it
+            full = Broadcaster.struct((1 << len(values)) - 1)
+            values = full.unpack(full.pack(*values))
+            if joined or keyframe is None or sequence - key_sequence >= Broadcaster.keyframe_every:
+                keyframe = None
+                key_sequence = sequence
+            data = Broadcaster.encode(sequence, key_sequence, values, keyframe)
+            if keyframe is None:
+                keyframe = values
+            for address in list(self.subscribers):
+                try:
+                    self.socket.sendto(data, address)
+                except OSError:
+                    del self.subscribers[address]
+
+    def close(self) -> None:
+        self.running = False
+        self.thread.join()
+        self.socket.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.bind):
+            os.remove(self.bind)
+
+
+#Window that shows a broadcast game on a table of its own. The table is only drawn, never stepped: every frame the
+#newest state received is put onto it with Table.restore
+class Spectator(object):
+    def __init__(self, address) -> None:
+        self.family, self.server = Broadcaster.parse(address)
+        self.socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        self.path = None
+        if self.family == socket.AF_UNIX:
+            self.path = "{}.spectator{}".format(self.server, os.getpid())
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.socket.bind(self.path)
+        self.socket.setblocking(False)
+        pygame.display.init()
+        pygame.font.init()
+        self.screen = pygame.display.set_mode(Settings.dim())
+        pygame.display.set_caption(Settings.title + " spectator")
+        self.background = Background()
+        self.table = Table()
+        self.keyframe = None
+        self.key_sequence = None
+        self.values = None
+        self.hello = Timer(1000)
+        self.running = False
+
+    def receive(self) -> None:
+        while True:
+            try:
+                data = self.socket.recv(256)
+            except (BlockingIOError, InterruptedError):
+                return
+            frame = Broadcaster.decode(data)
+            if frame is None:
+                continue
+            sequence, key_sequence, values = frame
+            if sequence == key_sequence:
+                self.keyframe = values
+                self.key_sequence = key_sequence
+            elif key_sequence != self.key_sequence:
+                continue
+            self.values = dict(self.keyframe, **values)
+
+    def show(self) -> None:
+        values = self.values
+        gameover = bool(values['gameover'])
+        ball = (values['ball_x'], values['ball_y'])
+        state = TableState(array('d', ball + ball + (values['ball_vx'], values['ball_vy'], values['left_angle'],
+                                                      values['left_angle'], 0.0, values['right_angle'], values['right_angle'],
+                                                      0.0, values['force'], values['force'] > 0, False, values['ball_number'],
+                                                      values['points'], gameover, 0.0, 1.0)),
+                           "Gameover Press R to restart" if gameover else "")
+        self.table.restore(state)
+
+    def run(self) -> None:
+        self.running = True
+        clock = Settings.clock
+        while self.running:
+            start = clock.now()
+            for event in pygame.event.get():
+                if event.type == QUIT or (event.type == KEYDOWN and event.key == K_ESCAPE):
+                    self.running = False
+            if self.hello.is_next_stop_reached():
+                try:
+                    self.socket.sendto(b'hello', self.server)
+                except OSError:
+                    pass
+            self.receive()
+            if self.values:
+                self.show()
+            self.background.draw(self.screen)
+            self.table.draw(self.screen)
+            pygame.display.flip()
+            clock.sleep(clock.speed / Settings.fps - (clock.now() - start))
+        self.socket.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        pygame.quit()
+
+
 #main class    
 class Game(object):
-    def __init__(self) -> None:
+    def __init__(self, record=None, profile=None, events=None) -> None:
         super().__init__()
         os.environ['SDL_VIDEO_WINDOW_POS'] = "10, 50"
-        pygame.init()
+        #Only the subsystems the game uses, the rest would only slow down the start
+        SoundBank.pre_init()
+        pygame.display.init()
+        pygame.font.init()
         self.screen = pygame.display.set_mode(Settings.dim())
         pygame.display.set_caption(Settings.title)
-        self.clock = pygame.time.Clock()
+        Assets.bundle = AssetBundle.open(self.screen)
+        SoundBank.start()
         self.background = Background()
         self.table = Table()
+        self.renderer = None
+        if Settings.dirty_rendering:
+            self.renderer = DirtyRenderer(self.screen, self.background, self.table)
+        self.record = record
+        if self.record:
+            self.table.recorder = InputRecorder()
+        self.clock = Settings.clock
+        self.profiler = Profiler()
+        self.frame_profiler = NullProfiler()
+        self.latency = LatencyMeter(clock=self.clock)
+        self.table.latency = self.latency
+        self.table.rewind = Rewind(self.table)
+        self.preview = LaunchPreview(self.table.chargedlauncher.sprite) if Settings.launch_preview else None
+        self.broadcaster = None
+        self.events = EventLog(events) if events else NullEventLog()
+        self.table.use_events(self.events)
+        self.profile = profile
+        self.overlay = None
+        self.enable_profiler()
+        self.lock = threading.Lock()
         self.running = False
 
     def run(self) -> None:
         self.running = True
+        physics = None
+        if Settings.physics_thread:
+            physics = threading.Thread(target=self.run_physics, name="physics")
+            physics.start()
+        last = self.frame_due = self.clock.now()
+        while self.running:
+            self.wait_for_frame()
+            profiler = self.frame_profiler
+            profiler.start_frame()
+            if physics:
+                with self.lock:
+                    self.watch_for_events()
+                    profiler.mark('events')
+                    layers, areas = self.capture()
+                self.present(layers, areas)
+            else:
+                self.watch_for_events()
+                profiler.mark('events')
+                now = self.clock.now()
+                Settings.deltatime = now - last
+                last = now
+                self.update(now)
+                self.draw()
+            self.latency.presented()
+            profiler.end_frame()
+        if physics:
+            physics.join()
+        if self.record:
+            self.table.recorder.finish(self.table.steps)
+            self.table.recorder.save(self.record)
+        if self.profile:
+            self.profiler.export(self.profile)
+        self.events.close()
+        if self.preview:
+            self.preview.close()
+        if self.broadcaster:
+            self.broadcaster.close()
+        self.quit()
+
+    #Steps the physics on its own thread, so a slow draw never holds it up. The main thread only takes the lock
+    #to hand over events and to take a snapshot of the layers, the drawing happens outside of it
+    def run_physics(self) -> None:
+        last = self.clock.now()
         while self.running:
-            Settings.deltatime = self.clock.tick(Settings.fps) / 1000
-            self.watch_for_events()
-            if not Settings.gameover: 
-                self.update()
-            self.draw()
+            now = self.clock.now()
+            with self.lock:
+                Settings.deltatime = now - last
+                self.update(now)
+            last = now
+            self.clock.sleep(Settings.timestep - (self.clock.now() - now))
+
+    #Sleeps until the next frame is due, looking for input every Settings.input_poll seconds meanwhile.
+    #A key pressed between two frames is stamped with the time it arrived instead of the start of the next frame.
+    #Frames are due fps times a second of real time, which is speed times as much game time
+    def wait_for_frame(self) -> None:
+        speed = self.clock.speed
+        while True:
+            now = self.clock.now()
+            if now >= self.frame_due:
+                break
+            with self.lock:
+                self.watch_for_events()
+            self.clock.sleep(min(Settings.input_poll * speed, self.frame_due - now))
+        self.frame_due = max(self.frame_due + speed / Settings.fps, now)
+
+    #The profiler only runs while its overlay is shown or a trace is written at the end.
+    #It is not thread safe, so a physics thread is not profiled
+    def enable_profiler(self) -> None:
+        if self.profile or self.overlay:
+            if self.frame_profiler is not self.profiler:
+                self.frame_profiler = self.profiler
+                self.profiler.start_frame()
+        else:
+            self.frame_profiler = NullProfiler()
+        self.table.profiler = NullProfiler() if Settings.physics_thread else self.frame_profiler
+        if self.renderer:
+            self.renderer.profiler = self.frame_profiler
+
+    def toggle_overlay(self) -> None:
+        self.overlay = None if self.overlay else ProfilerOverlay(self.profiler, self.latency)
+        self.enable_profiler()
+        if self.renderer:
+            self.renderer.previous = None
+
+    #Fonts and sounds die with pygame, so the shared caches are emptied first
+    @staticmethod
+    def quit() -> None:
+        Display.fonts.clear()
+        Display.rendered.clear()
+        Assets.clear()
+        Assets.bundle = None
+        SoundBank.clear()
         pygame.quit()
 
     def watch_for_events(self) -> None:
+        now = self.clock.now()
         for event in pygame.event.get():
-            self.table.watch_for_events(event)
+            if event.type in (KEYDOWN, KEYUP):
+                self.table.queue_input(event, now)
             if event.type == QUIT:
                 self.running = False
             elif event.type == KEYDOWN:
                 if event.key == K_ESCAPE:
                     self.running = False
+                elif event.key == K_F3:
+                    self.toggle_overlay()
               
 
-    def update(self) -> None:
-        self.table.update()
-    
+    def update(self, now=None) -> None:
+        self.table.update(self.clock.now() if now is None else now)
+
     def draw(self) -> None:
+        profiler = self.frame_profiler
+        self.latency.capture()
+        if self.broadcaster:
+            self.broadcaster.publish(self.table)
+        if self.overlay:
+            self.overlay.update()
+            profiler.mark('draw_overlay')
+        if self.preview:
+            self.preview.update()
+        if self.renderer:
+            self.renderer.draw(self.extra_layers())
+            return
         self.background.draw(self.screen)
+        profiler.mark('draw_background')
         self.table.draw(self.screen)
+        if self.preview:
+            self.screen.blit(self.preview.sprite.image, self.preview.sprite.rect)
+        if self.overlay:
+            self.overlay.draw(self.screen)
+            profiler.mark('draw_overlay')
+        pygame.display.flip()
+        profiler.mark('flip')
+
+    #The launch preview and the overlay, drawn above the table
+    def extra_layers(self):
+        return ([self.preview.sprite] if self.preview else []) + (self.overlay.lines if self.overlay else [])
+
+    #Layers of the table, preview and overlay with a snapshot of their images and rects
+    def capture(self):
+        self.latency.capture()
+        if self.broadcaster:
+            self.broadcaster.publish(self.table)
+        if self.overlay:
+            self.overlay.update()
+        if self.preview:
+            self.preview.update()
+        layers = self.table.layers() + self.extra_layers()
+        return layers, DirtyRenderer.snapshot(layers)
+
+    #Draws a capture like draw() does. The groups in it never move and can be drawn without the lock
+    def present(self, layers, areas) -> None:
+        profiler = self.frame_profiler
+        if self.renderer:
+            self.renderer.present(layers, areas)
+            return
+        self.background.draw(self.screen)
+        for layer, area in zip(layers, areas):
+            if area:
+                self.screen.blit(*area)
+            else:
+                layer.draw(self.screen)
+        profiler.mark('draw_dirty')
         pygame.display.flip()
+        profiler.mark('flip')
+
+
+#Runs the table without a window or mixer, stepping with a fixed timestep as fast as possible.
+#Its SimulatedClock advances with every step, so timers see the time of the game.
+#The table reads the settings below from Settings. A simulation keeps its own, enter() swaps them in and leave()
+#gives the caller's back, so neither the caller nor other simulations see them change
+class Simulation(object):
+    fields = ('headless', 'clock', 'timestep', 'gameover')
+
+    def __init__(self, timestep=None) -> None:
+        super().__init__()
+        self.clock = SimulatedClock()
+        self.settings = {'headless': True, 'clock': self.clock, 'timestep': timestep or Settings.timestep, 'gameover': False}
+        self.outside = None
+        self.enter()
+        try:
+            self.table = Table()
+        finally:
+            self.leave()
+
+    def enter(self) -> None:
+        self.outside = {field: getattr(Settings, field) for field in Simulation.fields}
+        for field, value in self.settings.items():
+            setattr(Settings, field, value)
+
+    def leave(self) -> None:
+        self.settings = {field: getattr(Settings, field) for field in Simulation.fields}
+        for field, value in self.outside.items():
+            setattr(Settings, field, value)
+
+    def press(self, key) -> None:
+        self.enter()
+        try:
+            self.table.watch_for_events(pygame.event.Event(KEYDOWN, key=key))
+        finally:
+            self.leave()
+
+    def release(self, key) -> None:
+        self.enter()
+        try:
+            self.table.watch_for_events(pygame.event.Event(KEYUP, key=key))
+        finally:
+            self.leave()
+
+    def step(self) -> bool:
+        self.enter()
+        try:
+            return self.advance()
+        finally:
+            self.leave()
+
+    #One physics step, with the settings of the simulation already entered
+    def advance(self) -> bool:
+        if Settings.gameover:
+            return False
+        self.table.step(Settings.timestep)
+        self.clock.advance(Settings.timestep)
+        return True
+
+    def run(self, steps) -> int:
+        self.enter()
+        try:
+            for _ in range(steps):
+                if not self.advance():
+                    break
+        finally:
+            self.leave()
+        return self.table.score.points
+
+
+#Feeds a recorded input log back into a headless table at full speed
+class Replay(Simulation):
+    def __init__(self, path) -> None:
+        settings, self.entries = InputRecorder.load(path)
+        Settings.substeps = settings['substeps']
+        Settings.collision = settings['collision']
+        Settings.balls = settings['balls']
+        super().__init__(settings['timestep'])
+        #The game keeps the states to rewind to, a replay only needs them if the player rewound
+        if any(kind == KEYDOWN and key == K_BACKSPACE for step, kind, key in self.entries):
+            self.table.rewind = Rewind(self.table)
+
+    def run(self) -> int:
+        self.enter()
+        try:
+            for step, kind, key in self.entries:
+                while self.table.steps < step and self.advance():
+                    pass
+                if kind is not None:
+                    self.table.watch_for_events(pygame.event.Event(kind, key=key))
+        finally:
+            self.leave()
+        return self.table.score.points
+
+
+#Table for automated players. An action is (left flipper, right flipper, launcher), each part held (1) or released (0).
+#Changes are sent as the same key events a player would press, so a recorder can capture the game. Every step runs
+#repeat physics steps and returns the observation, the points scored and whether the game is over
+class Environment(Simulation):
+    observation_names = ('ball_x', 'ball_y', 'ball_vx', 'ball_vy', 'left_angle', 'right_angle', 'launcher_force',
+                         'points', 'ball_number', 'gameover')
+    keys = (K_a, K_d, K_SPACE)
+
+    def __init__(self, timestep=None, repeat=1) -> None:
+        super().__init__(timestep)
+        self.repeat = repeat
+        self.ball = self.table.ball.sprite
+        self.flippers = (self.table.leftflipper.sprite, self.table.rightflipper.sprite)
+        self.launcher = self.table.chargedlauncher.sprite
+        self.held = [False, False, False]
+
+    def reset(self):
+        for flipper in self.flippers:
+            flipper.angle = flipper.target = flipper.rest_angle
+            flipper.angular_velocity = 0
+            flipper.show_frame()
+        self.launcher.charging = False
+        self.launcher.force = 0
+        self.held = [False, False, False]
+        self.enter()
+        try:
+            self.table.restart()
+        finally:
+            self.leave()
+        return self.observe()
+
+    def act(self, action) -> None:
+        for index, part in enumerate(action):
+            held = bool(part)
+            if held != self.held[index]:
+                self.held[index] = held
+                if held:
+                    self.press(Environment.keys[index])
+                else:
+                    self.release(Environment.keys[index])
+
+    def step(self, action):
+        points = self.table.score.points
+        self.act(action)
+        self.enter()
+        try:
+            for _ in range(self.repeat):
+                if not self.advance():
+                    break
+        finally:
+            self.leave()
+        return self.observe(), self.table.score.points - points, self.settings['gameover']
+
+    def observe(self):
+        ball = self.ball
+        ball.sync_position()
+        return (ball.pos[0], ball.pos[1], ball.direction[0], ball.direction[1], self.flippers[0].angle, self.flippers[1].angle,
+                self.launcher.force, self.table.score.points, self.launcher.ball_number, float(self.settings['gameover']))
+
+
+#Advances count independent tables in one call. Actions are a (count, 3) array, observations come back as a
+#(count, len(Environment.observation_names)) array next to arrays of the points scored and the gameover flags.
+#With auto_reset a finished table starts a new game right away and reports its first observation
+class BatchEnvironment(object):
+    def __init__(self, count, timestep=None, repeat=1, auto_reset=True) -> None:
+        if numpy is None:
+            raise ImportError("the batched environment needs numpy")
+        self.environments = [Environment(timestep, repeat) for _ in range(count)]
+        self.auto_reset = auto_reset
+
+    def __len__(self):
+        return len(self.environments)
+
+    def reset(self):
+        return numpy.array([environment.reset() for environment in self.environments])
+
+    def step(self, actions):
+        observations = []
+        rewards = []
+        done = []
+        for environment, action in zip(self.environments, numpy.asarray(actions).tolist()):
+            observation, reward, gameover = environment.step(action)
+            if gameover and self.auto_reset:
+                observation = environment.reset()
+            observations.append(observation)
+            rewards.append(reward)
+            done.append(gameover)
+        return numpy.array(observations), numpy.array(rewards), numpy.array(done)
 
 
 if __name__ == '__main__':
-    game = Game()
-    game.run()
+    parser = argparse.ArgumentParser(description=Settings.title)
+    parser.add_argument("--replay", help="play an input log back headless and print the score")
+    parser.add_argument("--record", help="write the key input of this game to an input log")
+    parser.add_argument("--profile", help="profile every frame and write a trace to this file when the game ends")
+    parser.add_argument("--balls", type=int, default=Settings.balls, help="balls on the table, more than one needs numpy")
+    parser.add_argument("--physics-rate", type=float, default=1.0 / Settings.timestep, help="physics steps per second")
+    parser.add_argument("--physics-thread", action="store_true", help="step the physics on its own thread")
+    parser.add_argument("--collision", choices=["mask", "analytic"], default=Settings.collision,
+                        help="pixel masks or line segments for the walls and rails")
+    parser.add_argument("--substeps", type=int, default=Settings.substeps, help="collision passes per physics step")
+    parser.add_argument("--dirty", action="store_true", help="redraw only the parts of the screen that changed")
+    parser.add_argument("--events", metavar="DIRECTORY", help="stream score changes, launches, drains and game overs to this directory")
+    parser.add_argument("--speed", type=float, default=1.0, help="game time per second of real time, 0.5 is slow motion")
+    parser.add_argument("--build-bundle", action="store_true", help="write the prepared images and sounds for this machine and exit")
+    parser.add_argument("--preview", action="store_true", help="show where the ball will go while the launcher charges")
+    parser.add_argument("--broadcast", metavar="ADDRESS", help="send the game to spectators at udp:HOST:PORT or unix:PATH")
+    parser.add_argument("--spectate", metavar="ADDRESS", help="watch a game broadcast at udp:HOST:PORT or unix:PATH")
+    parser.add_argument("--latency", action="store_true", help="print the flipper key latency percentiles at the end")
+    arguments = parser.parse_args()
+    Settings.balls = arguments.balls
+    Settings.timestep = 1.0 / arguments.physics_rate
+    Settings.physics_thread = arguments.physics_thread
+    Settings.collision = arguments.collision
+    Settings.substeps = max(1, arguments.substeps)
+    Settings.dirty_rendering = arguments.dirty
+    Settings.clock = RealClock(arguments.speed)
+    Settings.launch_preview = arguments.preview
+    if arguments.build_bundle:
+        path = Settings.bundlepath()
+        entries, size = AssetBundle.build(path)
+        print("{} entries, {:.1f} MB in {}".format(entries, size / 1e6, path))
+    elif arguments.replay:
+        print(Replay(arguments.replay).run())
+    elif arguments.spectate:
+        Spectator(arguments.spectate).run()
+    else:
+        game = Game(arguments.record, arguments.profile, arguments.events)
+        if arguments.broadcast:
+            game.broadcaster = Broadcaster(arguments.broadcast)
+        game.run()
+        if arguments.latency:
+            print(game.latency.report())
@@ -0,0 +1,179 @@
+import argparse
+import csv
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+#Fires the DebugLauncher headless for every combination of launch position, angle and force and reports where the ball went.
+#"python sweep.py --angle 0:45:5 --force 500:3000:250" replaces nudging the DebugLauncher in the game one key press at a time
+class Sweep(object):
+    outcomes = ["drained", "launcher", "timeout"]
+
+    #Builds the table once per worker process, every launch then starts from a reset of it
+    @staticmethod
+    def setup(collision, timestep, seconds, layout) -> None:
+        from pinball_45 import Settings, Simulation, DebugLauncher
+        Settings.collision = collision
+        Settings.layout = layout
+        Sweep.settings = Settings
+        Sweep.simulation = Simulation(timestep)
+        #Every launch runs on this table, so the settings of the simulation stay in place
+        Sweep.simulation.enter()
+        Sweep.table = Sweep.simulation.table
+        Sweep.max_steps = int(round(seconds / timestep))
+        Sweep.launcher = DebugLauncher(0, 0, 25, 25, "debuglauncher.png", 0, 0, Sweep.table.ball)
+
+    #Returns where one ball launched from (x, y) at angle and force went within the time limit
+    @staticmethod
+    def launch(combination):
+        x, y, angle, force = combination
+        table = Sweep.table
+        ball = table.ball.sprite
+        launcher = table.chargedlauncher.sprite
+        Sweep.settings.gameover = False
+        table.score.reset()
+        launcher.ball_number = 1
+        launcher.controlling = False
+        table.hits = []
+        debuglauncher = Sweep.launcher
+        debuglauncher.pos_x, debuglauncher.pos_y, debuglauncher.angle, debuglauncher.force = x, y, angle, force
+        debuglauncher.launch_ball()
+
+        flippers = [table.leftflipper.sprite, table.rightflipper.sprite]
+        reached_flippers = False
+        outcome = "timeout"
+        steps = Sweep.max_steps
+        for step in range(1, Sweep.max_steps + 1):
+            Sweep.simulation.advance()
+            if launcher.ball_number != 1:
+                outcome = "drained"
+                steps = step
+                break
+            if launcher.controlling:
+                outcome = "launcher"
+                steps = step
+                break
+            if not reached_flippers:
+                for flipper in flippers:
+                    if flipper.rect.colliderect(ball.rect) and flipper.segment.contact(ball.pos, ball.radius + 1, ball.direction):
+                        reached_flippers = True
+        hits = []
+        for index in table.hits:
+            if index not in hits:
+                hits.append(index)
+        return {'x': x, 'y': y, 'angle': angle, 'force': force, 'outcome': outcome, 'time': steps * Sweep.settings.timestep,
+                'reached_flippers': reached_flippers, 'hits': hits, 'score': table.score.points}
+
+    #"start:stop:step" with stop included, "start:stop" steps by 1, a single number is one value
+    @staticmethod
+    def values(text):
+        parts = [float(part) for part in text.split(":")]
+        if len(parts) == 1:
+            return parts
+        start, stop = parts[0], parts[1]
+        step = parts[2] if len(parts) == 3 else 1.0
+        if step <= 0 or stop < start:
+            raise ValueError("range {} needs start <= stop and a positive step".format(text))
+        count = int((stop - start) / step + 1e-9) + 1
+        return [round(start + index * step, 6) for index in range(count)]
+
+    @staticmethod
+    def run(combinations, processes, collision, timestep, seconds, layout):
+        chunksize = max(1, len(combinations) // (processes * 8))
+        with ProcessPoolExecutor(processes, initializer=Sweep.setup, initargs=(collision, timestep, seconds, layout)) as pool:
+            return list(pool.map(Sweep.launch, combinations, chunksize=chunksize))
+
+    #Grid of value(results of a cell) with the angles as rows and the forces as columns, averaged over the positions
+    @staticmethod
+    def heatmap(title, results, value, cell="{:5.2f}"):
+        angles = sorted({result['angle'] for result in results})
+        forces = sorted({result['force'] for result in results})
+        cells = {}
+        for result in results:
+            cells.setdefault((result['angle'], result['force']), []).append(result)
+        lines = [title, "angle \\ force " + "".join("{:>6g}".format(force) for force in forces)]
+        for angle in angles:
+            row = []
+            for force in forces:
+                number = value(cells[(angle, force)])
+                row.append("{:>6}".format("-" if number is None else cell.format(number)))
+            lines.append("{:>13g} ".format(angle) + "".join(row))
+        return "\n".join(lines)
+
+    @staticmethod
+    def fraction(key, expected=True):
+        return lambda results: sum(result[key] == expected for result in results) / len(results)
+
+    @staticmethod
+    def drain_time(results):
+        times = [result['time'] for result in results if result['outcome'] == "drained"]
+        return sum(times) / len(times) if times else None
+
+    @staticmethod
+    def wall_table(results, layout):
+        lines = ["Walls and rails       launches that hit it   first hit"]
+        for index, (piece_class, x, y, width, height, image) in enumerate(layout.pieces_in_layout()):
+            hit = sum(index in result['hits'] for result in results) / len(results)
+            first = sum(bool(result['hits']) and result['hits'][0] == index for result in results) / len(results)
+            lines.append("{:>2} {:8} ({:g}, {:g}) {:>14.0%} {:>11.0%}".format(index, piece_class.__name__, x, y, hit, first))
+        return "\n".join(lines)
+
+    @staticmethod
+    def report(results, layout):
+        total = len(results)
+        summary = "  ".join("{} {:.0%}".format(outcome, sum(result['outcome'] == outcome for result in results) / total)
+                            for outcome in Sweep.outcomes)
+        summary += "  reached flippers {:.0%}".format(Sweep.fraction('reached_flippers')(results))
+        return "\n\n".join([summary,
+                            Sweep.heatmap("Drained, fraction of launches", results, Sweep.fraction('outcome', "drained")),
+                            Sweep.heatmap("Back in the launcher, fraction of launches", results, Sweep.fraction('outcome', "launcher")),
+                            Sweep.heatmap("Reached the flippers, fraction of launches", results, Sweep.fraction('reached_flippers')),
+                            Sweep.heatmap("Mean time to drain in seconds", results, Sweep.drain_time),
+                            Sweep.wall_table(results, layout)])
+
+    @staticmethod
+    def save(results, path) -> None:
+        with open(path, 'w', newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(['x', 'y', 'angle', 'force', 'outcome', 'time', 'reached_flippers', 'hits', 'score'])
+            for result in results:
+                writer.writerow([result['x'], result['y'], result['angle'], result['force'], result['outcome'], result['time'],
+                                 int(result['reached_flippers']), " ".join(str(index) for index in result['hits']), result['score']])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Launch sweeps for Pinball 45. Ranges are start:stop:step with stop included")
+    parser.add_argument("--x", default="440", help="launch x positions")
+    parser.add_argument("--y", default="120", help="launch y positions")
+    parser.add_argument("--angle", default="0:350:10", help="launch angles in degrees, counterclockwise from up")
+    parser.add_argument("--force", default="200:1200:100", help="launch forces")
+    parser.add_argument("--seconds", type=float, default=10.0, help="simulated time after which a launch counts as timeout")
+    parser.add_argument("--collision", choices=["mask", "analytic"], default="mask")
+    parser.add_argument("--layout", default="classic.json", help="table layout in tables/")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes, all cores by default")
+    parser.add_argument("--physics-rate", type=float, help="physics steps per second, the game's rate by default")
+    parser.add_argument("--csv", help="write every launch to this file")
+    arguments = parser.parse_args()
+    try:
+        ranges = [Sweep.values(text) for text in (arguments.x, arguments.y, arguments.angle, arguments.force)]
+    except ValueError as error:
+        parser.error(str(error))
+
+    from pinball_45 import Settings, Layout
+    timestep = 1.0 / arguments.physics_rate if arguments.physics_rate else Settings.timestep
+    combinations = list(itertools.product(*ranges))
+    start = time.perf_counter()
+    results = Sweep.run(combinations, arguments.processes, arguments.collision, timestep, arguments.seconds, arguments.layout)
+    print("{} launches in {:.1f} s on {} processes ({} collision, {:g} s limit)".format(
+        len(results), time.perf_counter() - start, arguments.processes, arguments.collision, arguments.seconds))
+    print(Sweep.report(results, Layout.load(Settings.tablepath(arguments.layout))))
+    if arguments.csv:
+        Sweep.save(results, arguments.csv)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())